@@ -0,0 +1,53 @@
+"""Bytes of memory per Thing, by kind of thing.
+
+    python benchmarks/memory.py
+    python benchmarks/memory.py --count 100000
+
+Each kind is measured by creating a pile of fresh things with `tracemalloc`
+running, and dividing the memory still in use by how many there are.  That
+includes anything a thing allocates for itself, like its health meter or
+inventory list, but not what it shares with other things of its type --
+which, for architecture, is everything.
+"""
+import argparse
+import os.path
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from raidne.game import things
+
+KINDS = [
+    ('architecture', things.wall),
+    ('item', things.potion),
+    ('creature', things.newt),
+]
+
+def bytes_per_thing(thing_type, count):
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        pile = [thing_type() for _ in range(count)]
+        # Creatures get their health looked at as soon as they're on a map
+        for thing in pile:
+            getattr(thing, 'health', None)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Don't count the list holding them all
+    return (after - before - sys.getsizeof(pile)) / count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    for name, thing_type in KINDS:
+        print("{0:<14} {1:8.1f} bytes".format(name, bytes_per_thing(thing_type, args.count)))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
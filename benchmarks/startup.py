@@ -0,0 +1,99 @@
+"""Time from launching the console UI to its first frame, plus a breakdown of
+where import time goes.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --budget 150   # fail if slower than 150ms
+
+Each run is a fresh interpreter, which imports the UI, sets up a new game,
+and renders one frame of it to an offscreen canvas.  The import breakdown
+comes from `python -X importtime`, sorted by cumulative time.
+
+With --budget, exits nonzero if the median time to first frame (not counting
+the interpreter's own startup) is over the budget, in milliseconds.
+"""
+import argparse
+import os.path
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FIRST_FRAME = """
+import time
+start = time.perf_counter()
+import urwid
+urwid.set_encoding('utf8')
+from raidne.ui.console import RaidneInterface
+imported = time.perf_counter()
+ui = RaidneInterface(seed=0)
+ui.main_widget.render((120, 50), focus=True)
+drawn = time.perf_counter()
+ui.dungeon.close()
+print(imported - start, drawn - start)
+"""
+
+def _python(args, **kwargs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.run(
+        [sys.executable] + args, env=env, cwd=ROOT, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        **kwargs)
+
+def time_to_first_frame(runs):
+    """Returns lists of import times and first frame times, in seconds."""
+    imports = []
+    frames = []
+    for _ in range(runs):
+        imported, drawn = map(float, _python(['-c', FIRST_FRAME]).stdout.split())
+        imports.append(imported)
+        frames.append(drawn)
+    return imports, frames
+
+def import_times(module='raidne.ui.console'):
+    """Returns (cumulative microseconds, self microseconds, module name) for
+    everything imported along with `module`, slowest first.
+    """
+    stderr = _python(['-X', 'importtime', '-c', 'import ' + module]).stderr
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header
+            continue
+        times.append((cumulative_us, self_us, fields[2].strip()))
+    times.sort(reverse=True)
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20,
+        help="how many of the slowest imports to list")
+    parser.add_argument('--budget', type=float, metavar='MS',
+        help="fail if the median time to first frame is over this")
+    args = parser.parse_args(argv)
+
+    print("{0:>10} {1:>10}  {2}".format('cumul. ms', 'self ms', 'module'))
+    for cumulative_us, self_us, name in import_times()[:args.top]:
+        print("{0:10.1f} {1:10.1f}  {2}".format(cumulative_us / 1000, self_us / 1000, name))
+    print()
+
+    imports, frames = time_to_first_frame(args.runs)
+    frame_ms = statistics.median(frames) * 1000
+    print("imports:      {0:7.1f} ms (median of {1})".format(
+        statistics.median(imports) * 1000, args.runs))
+    print("first frame:  {0:7.1f} ms".format(frame_ms))
+
+    if args.budget is not None and frame_ms > args.budget:
+        print("Over budget by {0:.1f} ms".format(frame_ms - args.budget))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""Turns-per-second benchmarks over a range of floor sizes and monster
+densities, using the headless driver.
+
+    python benchmarks/turns.py                       # just print results
+    python benchmarks/turns.py --save baseline.json  # remember them
+    python benchmarks/turns.py --compare baseline.json
+
+With --compare, exits nonzero if any case got slower than the baseline by more
+than the tolerance.
+"""
+import argparse
+import json
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from raidne.game.floorcache import FloorCache
+from raidne.headless import run
+
+SIZES = [(40, 120), (80, 240), (160, 480)]
+DENSITIES = [0.005, 0.02, 0.05]
+
+def run_suite(turns, seed, sizes=SIZES, densities=DENSITIES, floor_cache=None):
+    results = {}
+    for rows, cols in sizes:
+        for density in densities:
+            name = "{0}x{1} @ {2}".format(rows, cols, density)
+            _, result = run(rows=rows, cols=cols, density=density,
+                turns=turns, seed=seed, floor_cache=floor_cache)
+            results[name] = result.turns / result.elapsed
+            print("{0:<20} {1:10.1f} turns/sec".format(name, results[name]))
+            sys.stdout.flush()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed slowdown relative to the baseline (default 20%%)")
+    parser.add_argument('--floor-cache', metavar='DIR',
+        help="reuse floors generated by earlier runs, stored in DIR")
+    args = parser.parse_args(argv)
+
+    floor_cache = FloorCache(args.floor_cache) if args.floor_cache else None
+    results = run_suite(args.turns, args.seed, floor_cache=floor_cache)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for name, rate in sorted(results.items()):
+            if name not in baseline:
+                continue
+            change = rate / baseline[name] - 1
+            print("{0:<20} {1:+7.1%}".format(name, change))
+            if change < -args.tolerance:
+                regressions.append(name)
+
+        if regressions:
+            print("Regressed: " + ", ".join(regressions))
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
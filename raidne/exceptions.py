@@ -2,3 +2,6 @@
 
 class CollisionError(Exception):
     message = "two mutually-exclusive things tried to occupy the same space"
+
+class GameOver(Exception):
+    message = "you died, game over!!"
@@ -3,10 +3,20 @@
 
 from raidne import exceptions
 from raidne.game import effect
-from raidne.util import Position
 
 class Action(object):
-    pass
+    # How long this action takes, in ticks; see `raidne.game.schedule`
+    cost = 24
+
+
+class Wait(Action):
+    """Actor twiddles their thumbs for a turn."""
+
+    def __init__(self, actor):
+        self.actor = actor
+
+    def __call__(self, dungeon):
+        pass
 
 class MeleeAttack(Action):
     cost = 24  # TODO
@@ -25,7 +35,7 @@ class MeleeAttack(Action):
         yield damage, self.target
 
 
-class Walk(object):
+class Walk(Action):
     cost = 24  # TODO
 
     def __init__(self, actor, direction):
@@ -58,7 +68,7 @@ class Walk(object):
                     u','.join(item.name for item in items)))
 
 
-class Descend(object):
+class Descend(Action):
     # target is a staircase.
     # TODO do more standardized initialization and specifying of targets;
     # eventually these should all inherit from some Event base class
@@ -71,9 +81,11 @@ class Descend(object):
         self.target = target
 
     def __call__(self, dungeon):
+        # TODO circular import
+        from raidne.game import things
         map = dungeon.current_floor
         # XXX this is just all kinds of wrong.
-        if self.actor == dungeon.player and not map.find(self.actor).architecture.__class__.__name__ == 'StaircaseDown':
+        if self.actor == dungeon.player and not map.find(self.actor).architecture.isa(things.staircase_down):
             dungeon.message("You can't go down here.")
             return
 
@@ -81,13 +93,14 @@ class Descend(object):
 
         # XXX THIS IS DEFINITELY ALL KINDS OF WRONG.  WHERE SHOULD THIS LOGIC GO OMG
         assert self.actor == dungeon.player
-        map = dungeon.current_floor = dungeon.floors[1]  # XXX uhhhhhh.
-        # XXX need to put the player on the corresponding up staircase, or
-        # somewhere else if it's blocked or doesn't exist...
-        map.put(self.actor, Position(1, 1))
+        # The player lands on the next floor's entrance, or as close as they
+        # can get
+        depth = map.depth + 1
+        dungeon.send_to_floor(self.actor, depth)
+        dungeon.enter_floor(depth)
 
 
-class PickUp(object):
+class PickUp(Action):
     """Actor is picking up an item."""
 
     def __init__(self, actor, target):
@@ -0,0 +1,177 @@
+"""Architecture for floors too big to keep in memory all at once.
+
+A chunked floor is cut into square chunks, each generated from the floor's
+seed the first time anything looks at it -- walking, field of view, the
+renderer, whatever.  Only the most recently used chunks stay in memory.  The
+rest are dropped, if they can simply be generated again, or written to disk,
+if something on them has changed.  Since everything interesting happens near
+the player, the least recently used chunks are the ones far away from them.
+"""
+from collections import OrderedDict
+import os
+import os.path
+import weakref
+
+from raidne.game import things
+
+class ChunkedArchitectureLayer(object):
+    """Drop-in replacement for `ArchitectureLayer` that only materializes
+    the parts of the floor in use.
+
+    `fractor` has to have a `generate_chunk(seed, chunk_row, chunk_col,
+    chunk_size)` method returning a `bytearray` of `chunk_size` squared type
+    codes, in row-major order; it's given the same `seed` every time.
+    """
+    # Must be a power of two
+    chunk_size = 64
+    resident_limit = 256
+
+    def __init__(self, size, fractor, seed, chunk_size=None, resident_limit=None):
+        self.size = size
+        self.fractor = fractor
+        self.seed = seed
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if resident_limit is not None:
+            self.resident_limit = resident_limit
+        assert self.chunk_size & (self.chunk_size - 1) == 0
+        self._shift = self.chunk_size.bit_length() - 1
+        self._mask = self.chunk_size - 1
+
+        # (chunk row, chunk col) => bytearray, least recently used first
+        self._chunks = OrderedDict()
+        # Chunks that don't match what the fractor would generate
+        self._modified = set()
+        self._on_disk = set()
+        self.directory = None
+
+        # Most lookups land in the same chunk as the last one
+        self._last_key = None
+        self._last_chunk = None
+
+    def _chunk(self, row, col):
+        key = row >> self._shift, col >> self._shift
+        if key == self._last_key:
+            return self._last_chunk
+
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+        else:
+            chunk = self._load(key)
+            self._chunks[key] = chunk
+            self._evict()
+
+        self._last_key = key
+        self._last_chunk = chunk
+        return chunk
+
+    def _load(self, key):
+        if key in self._on_disk:
+            with open(self._path(key), 'rb') as f:
+                return bytearray(f.read())
+        chunk = self.fractor.generate_chunk(self.seed, key[0], key[1], self.chunk_size)
+        assert len(chunk) == self.chunk_size ** 2
+        return chunk
+
+    def _path(self, key):
+        if self.directory is None:
+            import shutil, tempfile
+            self.directory = tempfile.mkdtemp(prefix='raidne-chunks-')
+            weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        return os.path.join(self.directory, 'chunk-{0}-{1}.bin'.format(*key))
+
+    def _evict(self):
+        while len(self._chunks) > self.resident_limit:
+            key, chunk = self._chunks.popitem(last=False)
+            if key == self._last_key:
+                self._last_key = self._last_chunk = None
+            # Untouched chunks can just be generated again
+            if key in self._modified:
+                with open(self._path(key), 'wb') as f:
+                    f.write(chunk)
+                self._on_disk.add(key)
+
+    def _index(self, row, col):
+        return ((row & self._mask) << self._shift) | (col & self._mask)
+
+    def resident_chunks(self):
+        return len(self._chunks)
+
+    def modified_chunks(self):
+        """Yields ((chunk row, chunk col), bytes) for every chunk that's been
+        changed since it was generated.
+        """
+        for key in sorted(self._modified):
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                with open(self._path(key), 'rb') as f:
+                    chunk = f.read()
+            yield key, bytes(chunk)
+
+    def restore_chunk(self, key, data):
+        """Puts back a chunk returned by `modified_chunks`."""
+        assert len(data) == self.chunk_size ** 2
+        self._chunks[key] = bytearray(data)
+        self._modified.add(key)
+        if key == self._last_key:
+            self._last_key = self._last_chunk = None
+        self._evict()
+
+    def __getitem__(self, position):
+        code = self._chunk(position.row, position.col)[self._index(position.row, position.col)]
+        return things.Architecture.by_code[code].singleton
+
+    def __setitem__(self, position, architecture):
+        """Accepts either an `Architecture` type or a Thing of one."""
+        if isinstance(architecture, things.Thing):
+            architecture = architecture._type
+        row, col = position
+        self._chunk(row, col)[self._index(row, col)] = architecture.type_code
+        self._modified.add((row >> self._shift, col >> self._shift))
+
+    def type_at(self, position):
+        return things.Architecture.by_code[
+            self._chunk(position.row, position.col)[self._index(position.row, position.col)]]
+
+    def solid_at(self, row, col):
+        """Whether the architecture at (`row`, `col`) is solid."""
+        return things.Architecture.solid_codes[self._chunk(row, col)[self._index(row, col)]]
+
+    def row_codes(self, row, start=0, stop=None):
+        """Returns the type codes for the columns from `start` to `stop` of a
+        single row, as a `bytearray`.  Don't ask for a whole row of a really
+        big floor.
+        """
+        if stop is None:
+            stop = self.size.cols
+        codes = bytearray()
+        base = (row & self._mask) << self._shift
+        col = start
+        while col < stop:
+            chunk_stop = min(stop, (col | self._mask) + 1)
+            offset = base | (col & self._mask)
+            codes += self._chunk(row, col)[offset:offset + chunk_stop - col]
+            col = chunk_stop
+        return codes
+
+    def fill_rect(self, top, left, height, width, architecture):
+        """Sets a whole rectangle to the same architecture, a row slice of a
+        chunk at a time.
+        """
+        assert 0 <= top and top + height <= self.size.rows
+        assert 0 <= left and left + width <= self.size.cols
+        if isinstance(architecture, things.Thing):
+            architecture = architecture._type
+        code = architecture.type_code
+
+        for row in range(top, top + height):
+            base = (row & self._mask) << self._shift
+            col = left
+            while col < left + width:
+                chunk_stop = min(left + width, (col | self._mask) + 1)
+                offset = base | (col & self._mask)
+                self._chunk(row, col)[offset:offset + chunk_stop - col] = (
+                    bytes([code]) * (chunk_stop - col))
+                self._modified.add((row >> self._shift, col >> self._shift))
+                col = chunk_stop
@@ -0,0 +1,225 @@
+"""Finding out which parts of a floor can be reached from which, and fixing it
+when they can't.
+
+Works on a flat row-major array of architecture type codes, like the one in an
+`ArchitectureLayer` or a single chunk of a `ChunkedArchitectureLayer`.  Each
+row is chopped into runs of passable tiles (which is done with byte-string
+searches, so it's cheap), and then the runs are merged with union-find
+wherever they touch a run in the row above.  So the whole thing is linear in
+the size of the floor, and in practice mostly in the number of runs.
+"""
+from bisect import bisect_right
+
+from raidne.game import things
+from raidne.util import Position
+
+def _passable_table():
+    solid = things.Architecture.solid_codes
+    return bytes(
+        0 if code < len(solid) and solid[code] else 1
+        for code in range(256))
+
+
+class Regions(object):
+    """Connected areas of passable architecture, labelled from 0 in the order
+    they're first found (top to bottom, left to right).
+    """
+    def __init__(self, codes, rows, cols):
+        self.rows = rows
+        self.cols = cols
+
+        passable = bytes(codes).translate(_passable_table())
+
+        # Union-find over every run on the floor
+        parents = []
+        def find(run):
+            root = run
+            while parents[root] != root:
+                root = parents[root]
+            while parents[run] != root:
+                parents[run], run = root, parents[run]
+            return root
+
+        # Per row: run starts, run ends, run ids
+        row_runs = []
+        previous = ((), (), ())
+        for row in range(rows):
+            offset = row * cols
+            starts = []
+            ends = []
+            ids = []
+            prev_starts, prev_ends, prev_ids = previous
+            i = 0
+            position = offset
+            row_end = offset + cols
+            while True:
+                # find() on a single byte is a memchr, which beats any regex
+                start = passable.find(1, position, row_end)
+                if start < 0:
+                    break
+                end = passable.find(0, start, row_end)
+                if end < 0:
+                    end = row_end
+                position = end
+                start -= offset
+                end -= offset
+
+                run = len(parents)
+                parents.append(run)
+
+                # Join up with every run in the row above that shares a column
+                while i < len(prev_starts) and prev_ends[i] <= start:
+                    i += 1
+                j = i
+                while j < len(prev_starts) and prev_starts[j] < end:
+                    root = find(prev_ids[j])
+                    if root != run:
+                        parents[root] = run
+                    j += 1
+                if j > i:
+                    # The last one might touch the next run on this row, too
+                    i = j - 1
+
+                starts.append(start)
+                ends.append(end)
+                ids.append(run)
+            previous = starts, ends, ids
+            row_runs.append(previous)
+
+        # Turn the roots into consecutive labels
+        labels = {}
+        sizes = []
+        representatives = []
+        for row, (starts, ends, ids) in enumerate(row_runs):
+            for k, run in enumerate(ids):
+                root = find(run)
+                label = labels.get(root)
+                if label is None:
+                    label = labels[root] = len(sizes)
+                    sizes.append(0)
+                    representatives.append(Position(row, starts[k]))
+                sizes[label] += ends[k] - starts[k]
+                ids[k] = label
+
+        self._row_runs = row_runs
+        self.sizes = sizes
+        self.representatives = representatives
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def region_at(self, position):
+        """Returns the label of the region containing `position`, or `None` if
+        it's solid.
+        """
+        starts, ends, labels = self._row_runs[position.row]
+        k = bisect_right(starts, position.col) - 1
+        if k >= 0 and position.col < ends[k]:
+            return labels[k]
+        return None
+
+    def largest(self):
+        return max(range(len(self.sizes)), key=self.sizes.__getitem__)
+
+    def unreachable_from(self, position):
+        """Returns (representative position, size) for every region that
+        can't be reached from `position`.
+        """
+        home = self.region_at(position)
+        return [
+            (self.representatives[label], size)
+            for label, size in enumerate(self.sizes)
+            if label != home]
+
+
+def connect(codes, rows, cols, start=None):
+    """Adds corridors to a flat array of type codes until every passable tile
+    can be reached from `start`, or from the biggest region if there's no
+    `start`.
+
+    This is one breadth-first search outwards from the connected part of the
+    floor, through solid tiles too.  Whenever it runs into a stray region, a
+    corridor is dug back along the way it came, and the region joins the
+    search; so each region is joined to whatever connected floor is nearest,
+    and the whole thing is linear in the size of the floor.  Corridors stay
+    off the outermost rows and columns unless there's no other way.
+
+    Returns the `Regions` as they were before any digging, and the number of
+    corridors dug.
+    """
+    regions = Regions(codes, rows, cols)
+    if len(regions) <= 1:
+        return regions, 0
+
+    home = regions.region_at(start) if start is not None else None
+    if home is None:
+        home = regions.largest()
+
+    # Flat indices of every tile in each region
+    tiles = [[] for _ in range(len(regions))]
+    for row, (starts, ends, labels) in enumerate(regions._row_runs):
+        offset = row * cols
+        for run_start, run_end, label in zip(starts, ends, labels):
+            tiles[label].extend(range(offset + run_start, offset + run_end))
+
+    open_tiles = bytearray(bytes(codes).translate(_passable_table()))
+    floor = things.floor.type_code
+    size = rows * cols
+    # Where the search came from, for every tile it's reached; -1 for not yet
+    parents = [-1] * size
+    queue = list(tiles[home])
+    for index in queue:
+        parents[index] = index
+    remaining = len(regions) - 1
+    dug = 0
+
+    # Solid tiles around the edge, put off until nothing else is left
+    avoid_edges = rows > 2 and cols > 2
+    edges = []
+    head = 0
+    while remaining:
+        if head == len(queue):
+            if not avoid_edges:
+                # Can't happen: the search covers the whole floor
+                break
+            avoid_edges = False
+            for index, parent in edges:
+                if parents[index] < 0:
+                    parents[index] = parent
+                    queue.append(index)
+            continue
+
+        index = queue[head]
+        head += 1
+        row, col = divmod(index, cols)
+        for neighbor, ok in (
+                (index - cols, row > 0), (index + cols, row < rows - 1),
+                (index - 1, col > 0), (index + 1, col < cols - 1)):
+            if not ok or parents[neighbor] >= 0:
+                continue
+
+            if open_tiles[neighbor]:
+                # A stray region; dig back to the connected floor
+                tile = index
+                while not open_tiles[tile]:
+                    codes[tile] = floor
+                    open_tiles[tile] = 1
+                    tile = parents[tile]
+                dug += 1
+                remaining -= 1
+
+                region = tiles[regions.region_at(Position(*divmod(neighbor, cols)))]
+                for tile in region:
+                    parents[tile] = tile
+                queue.extend(region)
+                if not remaining:
+                    break
+            elif avoid_edges and (
+                    neighbor < cols or neighbor >= size - cols or
+                    neighbor % cols in (0, cols - 1)):
+                edges.append((neighbor, index))
+            else:
+                parents[neighbor] = index
+                queue.append(neighbor)
+
+    return regions, dug
@@ -0,0 +1,221 @@
+"""Optional columnar storage for the creatures on a floor.
+
+Normally each creature's state is spread around: its health is a `Meter` of
+its own, its attack power is on its type, and its position and turn order are
+in the map's dicts and schedule.  That's fine one creature at a time, but
+anything that touches every creature at once -- area effects, regeneration,
+finding who's near something -- ends up chasing pointers through thousands
+of objects.
+
+A `CreatureStore` keeps all of that in parallel arrays instead, one slot per
+creature.  The creatures' own `health` and `attack_power` become views into
+the arrays, so nothing else has to know the store exists; meanwhile whole-
+floor operations are single passes over flat columns.  See
+`Map.use_creature_store`.
+"""
+from array import array
+
+from raidne.game.things.bits import Meter
+
+class StoredMeter(object):
+    """A `Meter` whose values actually live in a `CreatureStore`."""
+    __slots__ = ('_store', '_slot', 'watcher')
+
+    def __init__(self, store, slot, watcher=None):
+        self._store = store
+        self._slot = slot
+        # Called with no arguments whenever the value changes
+        self.watcher = watcher
+
+    @property
+    def current(self):
+        return self._store.health[self._slot]
+
+    @current.setter
+    def current(self, value):
+        self._store.health[self._slot] = value
+
+    @property
+    def maximum(self):
+        return self._store.max_health[self._slot]
+
+    @maximum.setter
+    def maximum(self, value):
+        self._store.max_health[self._slot] = value
+
+    def modify(self, delta):
+        """Modify the current value, capping between the maximum and zero."""
+        health = self._store.health
+        slot = self._slot
+        health[slot] = min(max(health[slot] + delta, 0), self._store.max_health[slot])
+
+        if self.watcher is not None:
+            self.watcher()
+
+
+class CreatureStore(object):
+    """Parallel arrays of creature stats, one slot per creature.  Slots of
+    creatures that have left are reused; `things[slot]` is `None` for those.
+    """
+    def __init__(self):
+        self.health = array('q')
+        self.max_health = array('q')
+        self.attack_power = array('q')
+        self.rows = array('q')
+        self.cols = array('q')
+        # When each creature is next ready to act, as in the schedule
+        self.ready = array('q')
+
+        self.things = []
+        self.meters = []
+        self._slots = {}
+        self._free = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, thing):
+        return thing in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def slot_of(self, thing):
+        return self._slots[thing]
+
+    def add(self, thing, position, ready=0):
+        """Starts keeping `thing`'s stats here.  Its health becomes a view
+        into the store.
+        """
+        assert thing not in self._slots
+        meter = getattr(thing, 'health', None)
+        values = (
+            0 if meter is None else meter.current,
+            0 if meter is None else meter.maximum,
+            getattr(thing._type, 'attack_power', 0),
+            position.row,
+            position.col,
+            ready,
+        )
+        columns = (self.health, self.max_health, self.attack_power, self.rows, self.cols, self.ready)
+
+        if self._free:
+            slot = self._free.pop()
+            for column, value in zip(columns, values):
+                column[slot] = value
+            self.things[slot] = thing
+        else:
+            slot = len(self.things)
+            for column, value in zip(columns, values):
+                column.append(value)
+            self.things.append(thing)
+            self.meters.append(None)
+
+        self._slots[thing] = slot
+        stored = None
+        if meter is not None:
+            stored = StoredMeter(self, slot, meter.watcher)
+            thing._health = stored
+        self.meters[slot] = stored
+        thing._store = self
+        return slot
+
+    def remove(self, thing):
+        """Stops keeping `thing`'s stats here, giving it back a `Meter` of its
+        own.
+        """
+        slot = self._slots.pop(thing)
+        stored = self.meters[slot]
+        if stored is not None:
+            meter = Meter(self.max_health[slot])
+            meter.current = self.health[slot]
+            meter.watcher = stored.watcher
+            thing._health = meter
+        thing._store = None
+        self.things[slot] = None
+        self.meters[slot] = None
+        self._free.append(slot)
+
+    def replace_meter(self, thing, meter):
+        """Copies a whole new health `Meter` into `thing`'s slot."""
+        slot = self._slots[thing]
+        stored = self.meters[slot]
+        self.health[slot] = meter.current
+        self.max_health[slot] = meter.maximum
+        if stored is None:
+            stored = self.meters[slot] = StoredMeter(self, slot)
+            thing._health = stored
+        # Whoever was watching the old health keeps watching
+        if meter.watcher is not None:
+            stored.watcher = meter.watcher
+
+    def move(self, thing, position):
+        slot = self._slots[thing]
+        self.rows[slot] = position.row
+        self.cols[slot] = position.col
+
+    def set_ready(self, thing, time):
+        slot = self._slots.get(thing)
+        if slot is not None:
+            self.ready[slot] = time
+
+    ### Whole-floor operations
+
+    def within(self, position, radius):
+        """Returns the slots of every creature no further than `radius` (in
+        straight-line distance) from `position`.
+        """
+        row, col = position
+        limit = radius * radius
+        return [
+            slot for slot, (r, c, thing) in enumerate(zip(self.rows, self.cols, self.things))
+            if thing is not None and (r - row) * (r - row) + (c - col) * (c - col) <= limit]
+
+    def modify_health(self, slots, delta):
+        """Adds `delta` to the health of every creature in `slots`, capped as
+        with `Meter.modify`.  Creatures already at zero are dead, and are left
+        alone.
+
+        Returns the things whose health changed, and the things it brought
+        down to zero.  Nothing takes the dead off the map; pass them to
+        `Dungeon.remove_dead`.
+        """
+        health = self.health
+        max_health = self.max_health
+        changed = []
+        dead = []
+        for slot in slots:
+            meter = self.meters[slot]
+            old = health[slot]
+            if meter is None or old == 0:
+                continue
+            new = min(max(old + delta, 0), max_health[slot])
+            if new != old:
+                health[slot] = new
+                changed.append(slot)
+                if new == 0:
+                    dead.append(self.things[slot])
+        return self._notify(changed), dead
+
+    def regenerate(self, amount=1):
+        """Heals every living creature by `amount`, short of their maximum.
+        Returns the things whose health changed.
+        """
+        changed = [
+            slot for slot, (current, maximum, meter) in enumerate(
+                zip(self.health, self.max_health, self.meters))
+            if meter is not None and 0 < current < maximum]
+        health = self.health
+        max_health = self.max_health
+        for slot in changed:
+            health[slot] = min(health[slot] + amount, max_health[slot])
+        return self._notify(changed)
+
+    def _notify(self, slots):
+        things = []
+        for slot in slots:
+            watcher = self.meters[slot].watcher
+            if watcher is not None:
+                watcher()
+            things.append(self.things[slot])
+        return things
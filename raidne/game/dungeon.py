@@ -2,78 +2,227 @@
 for generating, saving, and loading them as the player progresses, as well as
 the interaction between the player and the game world.
 """
+from collections import defaultdict
+import random
+
 from raidne import exceptions
 from raidne.game import things
-from raidne.game.fractor import BSPFractor, RoomFractor
-from raidne.util import Offset, Position
+from raidne.game.action import Action
+from raidne.game.fractor import BSPFractor
+from raidne.game.replay import ReplayLog
+from raidne.game import storage
+from raidne.game.storage import FloorStore
 
 class Dungeon(object):
     """The game world itself."""
-    def __init__(self):
+    def __init__(self, seed=None, fractor=None, floor_cache=None, creature_stores=False,
+            prefetch=True):
+        self._setup(seed=seed, fractor=fractor, floor_cache=floor_cache,
+            creature_stores=creature_stores)
+        self.prefetch = prefetch
+
+        # Create the player object and inject it into the first floor
+        # XXX grody
+        self.player = things.Thing(type=things.player)
+        self.send_to_floor(self.player, 0)
+        self.enter_floor(0)
+
+    def _setup(self, seed, fractor, floor_cache=None, creature_stores=False):
+        """Sets up everything but the player and the floors' contents; shared
+        with `load`.
+        """
         self._message_queue = []
+        # Metadata from the saved game this was loaded from, if any, and
+        # (for an autosave) how much of its journal was replayed; see
+        # `raidne.game.journal`
+        self.save_metadata = {}
+        self.journal_state = None
+
+        # Everything random in the game derives from this seed, so together
+        # with the player's actions it's enough to reproduce a whole game
+        if seed is None:
+            seed = random.randrange(2**64)
+        self.seed = seed
 
         # TODO Need some better idea of how the dungeon should be structured.
-        # List of floors isn't really going to cut it.  Floors should probably
-        # identify themselves and know their own connections, in which case:
-        # does the dungeon itself need to know much?  Also, should floors
-        # remember their connections as weakrefs, or just identifiers that this
-        # object looks up?
+        # Floors should probably identify themselves and know their own
+        # connections, in which case: does the dungeon itself need to know
+        # much?  Also, should floors remember their connections as weakrefs,
+        # or just identifiers that this object looks up?
 
-        fractor = BSPFractor()
-        self.floors = []
-        self.floors.append(fractor.generate())
-        self.floors.append(fractor.generate())
+        if fractor is None:
+            fractor = BSPFractor()
+        self.fractor = fractor
 
-        self.current_floor = self.floors[0]
+        # The fractor goes in the log too, since the same seed makes
+        # different floors with different fractors.  Nothing extra is
+        # scattered around unless a driver says so; see `replay.set_up`
+        self.replay_log = ReplayLog(
+            seed, metadata=dict(fractor=storage.describe_fractor(fractor), density=0))
+        # Optional `FloorCache`, to skip generating floors that have been
+        # generated before
+        self.floor_cache = floor_cache
+        # Whether every floor keeps its creatures in a `CreatureStore`
+        self.creature_stores = creature_stores
 
-        # TODO Eventually, all but the current dungeon floors will be stored on
-        # disk; no need to keep them going if they're not playing.  When that
-        # happens, moving items between floors (including the player's starting
-        # position) will have to work by having a Dungeon.moving_things dict,
-        # mapping floor identifiers to lists of things waiting to move there.
+        # Only the current floor (and maybe the last one visited) are kept in
+        # memory; the rest live on disk.  Things moving between floors are
+        # parked in moving_things, keyed by depth, until their destination is
+        # loaded.
+        self.moving_things = defaultdict(list)
+        # Floors are generated the first time they're needed, but the one
+        # below the player is normally started in the background, so it's
+        # usually ready by the time they take the stairs.
+        self.floors = FloorStore(
+            generate=self._generate_floor, on_load=self._floor_loaded)
+        # Off until whoever's creating or loading the dungeon says otherwise;
+        # the UI leaves it off until it's drawn something and then calls
+        # start_prefetching(), and batch runs leave it off entirely, so
+        # there are no threads to get in the way
+        self.prefetch = False
 
-        # Create the player object and inject it into the first floor
-        # XXX grody
-        self.player = things.Thing(type=things.player)
-        self.current_floor.put(self.player, Position(3, 3))
+    def _generate_floor(self, depth):
+        if self.floor_cache is not None:
+            return self.floor_cache.generate(self.fractor, self.floor_seed(depth))
+        return self.fractor.generate(seed=self.floor_seed(depth))
+
+    def _floor_loaded(self, floor):
+        """Called whenever a floor is brought into memory.  Delivers anything
+        that's been waiting to move there.
+        """
+        if self.creature_stores:
+            floor.use_creature_store()
+        for thing, position in self.moving_things.pop(floor.depth, ()):
+            self._arrive(floor, thing, position)
+
+    def send_to_floor(self, thing, depth, position=None):
+        """Puts `thing` on the floor at `depth`, which doesn't have to be in
+        memory or even exist yet.  The thing should already have been removed
+        from wherever it was.  If `position` isn't given, it goes to the
+        floor's entrance.  Either way, if the spot is taken, it ends up
+        somewhere nearby.
+        """
+        if self.floors.is_resident(depth):
+            self._arrive(self.floors[depth], thing, position)
+        else:
+            self.moving_things[depth].append((thing, position))
+
+    def _arrive(self, floor, thing, position):
+        if position is None:
+            position = floor.entrance
+        floor.put(thing, floor.nearest_open(position))
+
+    def enter_floor(self, depth):
+        """Makes the floor at `depth` the current one."""
+        self.current_floor = self.floors[depth]
+        if self.prefetch:
+            self.prefetch_next_floor()
+
+    def prefetch_next_floor(self):
+        """Starts generating the floor below this one in the background."""
+        self.floors.prefetch(self.current_floor.depth + 1)
+
+    def start_prefetching(self):
+        """Turns `prefetch` on, starting with the floor below this one."""
+        self.prefetch = True
+        self.prefetch_next_floor()
+
+    def close(self):
+        """Cleans up any floors stored on disk."""
+        self.floors.close()
+
+    def save(self, path):
+        """Saves the whole game to `path`."""
+        storage.save_dungeon(self, path)
+
+    @classmethod
+    def load(cls, path, prefetch=True):
+        """Loads a game saved with `save`.  Floors other than the current one
+        are read from the file as they're visited, so don't delete it until
+        this dungeon is closed.
+        """
+        return storage.load_dungeon(cls, path, prefetch=prefetch)
+
+    def floor_seed(self, depth):
+        """Returns the seed for the floor at `depth`.  Each floor gets its
+        own, so they come out the same regardless of the order they're
+        generated in.
+        """
+        return random.Random("{0}:{1}".format(self.seed, depth)).getrandbits(64)
 
     def do_monster_turns(self):
-        # Find all creatures
-        # XXX when real timing is implemented, we'll get a slightly less
-        # brute-force alg here that involves a queue of creatures that can go
-        # next
-        for position in self.current_floor.size.iter_positions():
-            tile = self.current_floor.tile(position)
-            if not tile.creature:
-                continue
-            if tile.creature is self.player:
+        """Lets every creature whose turn comes before the player's act."""
+        floor = self.current_floor
+        schedule = floor.schedule
+        while True:
+            actor = schedule.next_actor()
+            if actor is None or actor is self.player:
                 # XXX perhaps do the player's turn here.  hell we could make
                 # this the whole event loop and yield for the player.  8)
-                continue
-
-            # XXX probably want to pass a proxy object or something
-            action = tile.creature.think(self, self.current_floor)
-            if not action:
-                # we're done here
                 return
 
-            for effect, target in action(self) or []:
-                effect(self, action.actor, None, target)
+            action = self._think(actor, floor)
+            if action:
+                self._perform(action)
 
             # XXX this on the other hand is definitely not right
             if self.player.health.current == 0:
-                raise Exception("you died, game over!!")
+                raise exceptions.GameOver
+
+            # The actor might have died, or otherwise left the floor
+            self._spend(floor, actor, action)
 
     def player_command(self, action):
         """Call me when the player performs an action."""
         assert action.actor == self.player
 
+        self.replay_log.record(self, action)
+
+        floor = self.current_floor
+        self._perform(action)
+        self._spend(floor, self.player, action)
+
+    def _think(self, actor, floor):
+        # XXX probably want to pass a proxy object or something
+        return actor.think(self, floor)
+
+    def _perform(self, action):
+        """Carries out an action, and then all of its effects."""
         for effect, target in action(self) or []:
             effect(self, action.actor, None, target)
 
+    def _spend(self, floor, actor, action):
+        """Charges `actor` for performing `action`, if they're still around to
+        pay for it.  Doing nothing costs as much as the default action.
+        """
+        if actor in floor.schedule:
+            floor.schedule.spend(actor, getattr(action, 'cost', None) or Action.cost)
+
+    def remove_dead(self, floor, creatures):
+        """Announces the death of any of `creatures` that are out of health,
+        and takes them off `floor`.  For whatever hurts things, from a single
+        `effect.MeleeDamage` to `CreatureStore.modify_health` over a whole
+        area.
+        """
+        for creature in creatures:
+            # XXX meters should probably support bool or something
+            if creature in floor and creature.health.current == 0:
+                self.message("{0} dies".format(creature.name))
+                floor.remove(creature)
+
     def message(self, message):
         self._message_queue.append(message)
 
+    def pending_messages(self):
+        """Returns the messages not yet picked up by `new_messages`, leaving
+        them there.
+        """
+        return list(self._message_queue)
+
+    def restore_messages(self, messages):
+        """Replaces the pending messages, e.g. with ones from a save."""
+        self._message_queue = list(messages)
+
     def new_messages(self):
         # TODO for saving, it might be nice to remember old messages
         ret = self._message_queue
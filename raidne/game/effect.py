@@ -29,10 +29,7 @@ class MeleeDamage(Effect):
         # XXX this should probably go in the creature's damage handler.
         # XXX we need a real event queue to put this on
         # XXX looks like thing types can't use the python class system.  type needs to be an attr
-        if target.health.current == 0:
-            # XXX meters should probably support bool or something
-            dungeon.message("{0} dies".format(target.name))
-            dungeon.current_floor.remove(target)
+        dungeon.remove_dead(dungeon.current_floor, [target])
 
 
 class Heal(Effect):
@@ -0,0 +1,138 @@
+"""An on-disk cache of generated floors.
+
+Floors are entirely determined by the fractor that makes them and the seed
+it's given, so benchmarks and balance testing, which build the same floors
+over and over, can keep them around instead.  Entries are named by a hash of
+the fractor's class and parameters, its `version`, the seed, and the floor
+format version; changing any of those just misses the cache.
+
+The cache is bounded in size.  Every hit touches the file's modification
+time, and once the cache grows too big, the least recently used floors are
+deleted.
+"""
+import hashlib
+import json
+import mmap
+import os
+import os.path
+import tempfile
+import threading
+
+from raidne.game import storage
+
+class FloorCache(object):
+    """Generates floors through a fractor, unless they've been generated
+    before.
+    """
+    # 64 MiB
+    max_bytes = 64 * 1024 * 1024
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        # Floors can be generated on a background thread
+        self._lock = threading.Lock()
+        self._total_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(directory)
+            if entry.name.endswith('.floor'))
+
+    def key(self, fractor, seed):
+        description = storage.describe_fractor(fractor)
+        description.update(
+            seed=seed,
+            version=fractor.version,
+            format=storage.VERSION,
+        )
+        blob = json.dumps(description, sort_keys=True).encode('utf8')
+        return hashlib.sha256(blob).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.floor')
+
+    def generate(self, fractor, seed):
+        """Same as `fractor.generate(seed=seed)`, only maybe faster."""
+        path = self._path(self.key(fractor, seed))
+        map = self._load(path)
+        if map is not None:
+            self.hits += 1
+            return map
+
+        self.misses += 1
+        map = fractor.generate(seed=seed)
+        self._store(path, storage.dump_floor(map))
+        return map
+
+    def _load(self, path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with f:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return None
+        try:
+            data = memoryview(mapping)
+            try:
+                map, _ = storage.load_floor(data)
+            finally:
+                data.release()
+        except storage.StorageError:
+            # Written by something else, or truncated; it'll be replaced
+            return None
+        finally:
+            try:
+                mapping.close()
+            except BufferError:
+                # Something still has a view of it -- only ever the traceback
+                # of an error on its way out, which shouldn't be hidden by
+                # this one.  It's closed once that's gone
+                pass
+
+        # Mark it as recently used
+        os.utime(path)
+        return map
+
+    def _store(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory)
+                if entry.name.endswith('.floor')),
+            key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        # Get well under the limit, so this doesn't happen on every store
+        target = self.max_bytes * 3 // 4
+        for entry in entries:
+            if total <= target:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        self._total_bytes = total
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.floor'):
+                os.remove(entry.path)
+        self._total_bytes = 0
@@ -1,9 +1,12 @@
 """Procedural generation of dungeon maps.  "Fractor" is the agent noun form of
 "fractal", where "fractal" is a verb for the purposes of this explanation.
 """
-from raidne.game import things
-from raidne.game.map import Map
-from raidne.util import Position
+import itertools
+import random
+
+from raidne.game import connectivity, population, things
+from raidne.game.map import ArchitectureLayer, Map
+from raidne.util import Position, Size
 
 # TODO fractors should be able to fill a sub-area of a map
 
@@ -17,12 +20,27 @@ class Fractor(object):
     height = 40
     width = 120
 
-    def __init__(self):
-        # XXX get the player attributes, options, state, whatever else here
-        pass
+    # Bump this whenever a change means the same seed makes a different
+    # floor, so cached floors get regenerated
+    version = 4
 
-    def generate(self):
-        """Returns a brand spankin' new map."""
+    # What lives here, and how much of it: things per open floor tile
+    spawn_table = population.default_spawn_table
+    spawn_density = 0.005
+
+    def __init__(self, height=None, width=None, spawn_density=None):
+        # XXX get the player attributes, options, state, whatever else here
+        if height is not None:
+            self.height = height
+        if width is not None:
+            self.width = width
+        if spawn_density is not None:
+            self.spawn_density = spawn_density
+
+    def generate(self, seed=None):
+        """Returns a brand spankin' new map.  The same `seed` always produces
+        the same map.
+        """
         # The general approach here (in theory) follows several steps:
         # 1. Internally, draw rooms and hallways, so collision calculations can
         # be done without scattering architecture objects everywhere.
@@ -31,75 +49,212 @@ class Fractor(object):
         # 3. Then fill in other elements, like traps and items and monsters.
         raise NotImplementedError()
 
+    def populate(self, map, rng):
+        """Scatters monsters and items from the spawn table around the floor,
+        keeping them out of the player's face when they arrive.
+        """
+        free = len(population.free_tiles(map))
+        count = int(free * self.spawn_density)
+        avoid = (map.entrance,) if map.entrance is not None else ()
+        return population.populate(map, self.spawn_table, count, rng, avoid=avoid)
+
 class RoomFractor(Fractor):
     """Generates maps containing a simple room."""
 
-    def _scrap_canvas(self, height, width):
-        # TODO flesh this out into a real class with abstract shape objects
-        # like Room(), Hallway().  probably.  for now it's just a LoL
-        return [[None] * width for _ in range(height)]
-
-    def generate(self):
-        canvas = self._scrap_canvas(height=80, width=30)
+    def generate(self, seed=None):
+        rng = random.Random(seed)
+        canvas = ArchitectureLayer(Size(rows=80, cols=30))
         self.draw_room(canvas, top=0, bottom=79, left=0, right=29)
 
         # Place the stairs
-        canvas[10][10] = things.Thing(type=things.staircase_down)
-
-        map = Map.from_fractor_canvas(canvas)
+        canvas[Position(10, 10)] = things.staircase_down
 
-        # Place an item
-        map.put(things.Thing(type=things.potion), Position(2, 3))
-        # Or two
-        map.put(things.Thing(type=things.newt), Position(2, 9))
+        map = Map.from_architecture(canvas, seed=rng.getrandbits(64))
+        map.entrance = Position(1, 1)
 
+        self.populate(map, rng)
         return map
 
     def draw_room(self, map, top, bottom, left, right):
         """Draw a room with edges at the given offsets."""
         assert top < bottom
         assert left < right
-        assert 0 <= top < len(map)
-        assert 0 <= bottom < len(map)
-        assert 0 <= left < len(map[0])
-        assert 0 <= right < len(map[0])
+        assert 0 <= top < map.size.rows
+        assert 0 <= bottom < map.size.rows
+        assert 0 <= left < map.size.cols
+        assert 0 <= right < map.size.cols
 
         # Draw the top and bottom walls
         for col in range(left, right + 1):
-            map[top][col] = things.Thing(type=things.wall)
-            map[bottom][col] = things.Thing(type=things.wall)
+            map[Position(top, col)] = things.wall
+            map[Position(bottom, col)] = things.wall
 
         # Draw the left and right walls, and the space inside
         for row in range(top + 1, bottom):
-            map[row][left] = things.Thing(type=things.wall)
-            map[row][right] = things.Thing(type=things.wall)
+            map[Position(row, left)] = things.wall
+            map[Position(row, right)] = things.wall
 
             for col in range(left + 1, right):
-                map[row][col] = things.Thing(type=things.floor)
+                map[Position(row, col)] = things.floor
 
 
 class BSPFractor(Fractor):
     """Use binary partitioning to generate a Rogue-like assortment of rooms and
     hallways.
+
+    The floor is split in two, alternating more or less with its shape, and
+    each half is split again, down to `depth` levels or until the pieces get
+    too small to hold a room.  Each leaf gets a room somewhere inside it, and
+    after both halves of a split are done, a corridor joins a room from one to
+    a room from the other -- so the whole floor ends up connected.
     """
 
-    def generate(self):
+    # How many times to split, at most; there'll be up to 2**depth rooms
+    depth = 4
+    # Smallest room, counting only the floor inside
+    min_room_size = 4
+
+    def __init__(self, height=None, width=None, depth=None, min_room_size=None,
+            spawn_density=None):
+        super().__init__(height=height, width=width, spawn_density=spawn_density)
+        if depth is not None:
+            self.depth = depth
+        if min_room_size is not None:
+            self.min_room_size = min_room_size
+
+    def generate(self, seed=None):
+        rng = random.Random(seed)
         canvas = WorldCanvas(width=self.width, height=self.height)
+        self._split(canvas, self.depth, rng)
+        map = canvas.to_map(seed=rng.getrandbits(64))
+        self.populate(map, rng)
+        return map
 
-        midpoint = 30
-        subcanvas1, subcanvas2 = canvas.partition_vert(midpoint)
-
-        subcanvas1.add_box(subcanvas1.box.expand(-2))
-        subcanvas2.add_box(subcanvas2.box.expand(-2))
-
-        import pprint; pprint.pprint(canvas.__dict__)
-
-        return canvas.to_map()
-
-
-
+    def _split(self, canvas, depth, rng):
+        """Fills `canvas` with connected rooms, and returns one of them to
+        hook up to the rest of the floor.
+        """
+        box = canvas.box
+        # Rooms keep a wall's width from the edge of their partition, so no
+        # two rooms ever touch
+        min_part = self.min_room_size + 2
+
+        can_split_vert = box.width >= min_part * 2
+        can_split_horiz = box.height >= min_part * 2
+        if depth <= 0 or not (can_split_vert or can_split_horiz):
+            return self._place_room(canvas, rng)
+
+        # Cut across the longer side.  Character cells are about twice as
+        # tall as they are wide, so a partition only looks square when it has
+        # twice as many columns as rows
+        if can_split_vert and (not can_split_horiz or box.width >= box.height * 2):
+            midpoint = rng.randint(min_part, box.width - min_part)
+            halves = canvas.partition_vert(midpoint)
+        else:
+            midpoint = rng.randint(min_part, box.height - min_part)
+            halves = canvas.partition_horiz(midpoint)
+
+        room1 = self._split(halves[0], depth - 1, rng)
+        room2 = self._split(halves[1], depth - 1, rng)
+        canvas.add_corridor(room1.random_point(rng), room2.random_point(rng))
+        return rng.choice((room1, room2))
+
+    def _place_room(self, canvas, rng):
+        box = canvas.box.expand(-1)
+        width = rng.randint(min(self.min_room_size, box.width), box.width)
+        height = rng.randint(min(self.min_room_size, box.height), box.height)
+        room = Box(
+            box.x + rng.randint(0, box.width - width),
+            box.y + rng.randint(0, box.height - height),
+            width, height)
+        canvas.add_box(room)
+        return room
+
+
+
+class ChunkFractor(Fractor):
+    """Generates enormous open floors -- overworlds, caverns -- one chunk at a
+    time, as they're explored.  See `ChunkedArchitectureLayer`.
+
+    Each chunk is open ground with a few outcrops of rock.  The ground along
+    every chunk's edges is always left clear, so it's possible to get from
+    any chunk to the next.
+    """
+    height = 2 ** 20
+    width = 2 ** 20
+    chunk_size = 64
+    # Pockets of floor walled in by rock are dug out the shortest way now
+    version = 3
+    # Outcrops of rock per chunk, at most
+    outcrops = 12
+    # Furthest the down staircase can be from the entrance, in each direction
+    stairs_distance = 200
+
+    def generate(self, seed=None):
+        from raidne.game.chunks import ChunkedArchitectureLayer
+
+        rng = random.Random(seed)
+        architecture = ChunkedArchitectureLayer(
+            Size(rows=self.height, cols=self.width), self,
+            seed=rng.getrandbits(64), chunk_size=self.chunk_size)
+        map = Map.from_architecture(architecture, seed=rng.getrandbits(64))
+        map.entrance, _ = self.stairs(architecture.seed)
+        return map
 
-from collections import namedtuple
+    def stairs(self, seed):
+        """Returns where the up and down staircases go, as a pair of
+        positions.
+        """
+        rng = random.Random("{0}:stairs".format(seed))
+        # The entrance is in the middle of the first chunk
+        middle = self.chunk_size // 2
+        entrance = Position(middle, middle)
+        exit = Position(
+            middle + rng.randint(1, self.stairs_distance),
+            middle + rng.randint(1, self.stairs_distance))
+        return entrance, exit
+
+    def generate_chunk(self, seed, chunk_row, chunk_col, chunk_size):
+        rng = random.Random("{0}:{1}:{2}".format(seed, chunk_row, chunk_col))
+        codes = bytearray([things.floor.type_code]) * (chunk_size * chunk_size)
+        top = chunk_row * chunk_size
+        left = chunk_col * chunk_size
+
+        # Rock, kept off the chunk's edges
+        rock = bytes([things.wall.type_code])
+        for _ in range(rng.randint(0, self.outcrops)):
+            height = rng.randint(1, chunk_size // 4)
+            width = rng.randint(1, chunk_size // 4)
+            row = rng.randint(1, chunk_size - 1 - height)
+            col = rng.randint(1, chunk_size - 1 - width)
+            for r in range(row, row + height):
+                start = r * chunk_size + col
+                codes[start:start + width] = rock * width
+
+        # Walls around the edge of the whole floor
+        if top == 0:
+            codes[0:chunk_size] = rock * chunk_size
+        if top <= self.height - 1 < top + chunk_size:
+            start = (self.height - 1 - top) * chunk_size
+            codes[start:start + chunk_size] = rock * chunk_size
+        for r in range(chunk_size):
+            if left == 0:
+                codes[r * chunk_size] = rock[0]
+            if left <= self.width - 1 < left + chunk_size:
+                codes[r * chunk_size + self.width - 1 - left] = rock[0]
+
+        for position, stairs in zip(self.stairs(seed), (things.staircase_up, things.staircase_down)):
+            if (position.row // chunk_size, position.col // chunk_size) == (chunk_row, chunk_col):
+                codes[(position.row - top) * chunk_size + position.col - left] = stairs.type_code
+
+        # Outcrops can wall off little pockets; dig them out to the open
+        # ground, which is the biggest region since it runs around the edges
+        connectivity.connect(codes, chunk_size, chunk_size)
+
+        return codes
+
+
+from collections import defaultdict, namedtuple
 class Box(namedtuple('Box', ('x', 'y', 'width', 'height'))):
     __slots__ = ()
 
@@ -125,6 +280,12 @@ class Box(namedtuple('Box', ('x', 'y', 'width', 'height'))):
             0 <= self.x - other.x <= other.width or
             0 <= self.y - other.y <= other.height)
 
+    def random_point(self, rng):
+        """Returns a random (x, y) inside this box."""
+        return (
+            rng.randrange(self.x, self.x + self.width),
+            rng.randrange(self.y, self.y + self.height))
+
     def offset(self, x, y):
         return type(self)(
             self.x + x, self.y + y,
@@ -150,8 +311,114 @@ class Box(namedtuple('Box', ('x', 'y', 'width', 'height'))):
             range(self.x, self.x + self.width),
             range(self.y, self.y + self.height))
 
+    def distance_to(self, x, y):
+        """Returns the (Chebyshev) distance from the point (x, y) to the
+        nearest point inside this box; zero if it's inside.
+        """
+        dx = max(self.x - x, 0, x - (self.x + self.width - 1))
+        dy = max(self.y - y, 0, y - (self.y + self.height - 1))
+        return max(dx, dy)
 
 
+class BoxIndex(object):
+    """A bag of boxes, bucketed into a uniform grid so finding the ones near
+    some spot doesn't mean looking at all of them.  Otherwise acts like a
+    list, in the order the boxes were added.
+    """
+    bucket_size = 16
+
+    def __init__(self, bucket_size=None):
+        if bucket_size is not None:
+            self.bucket_size = bucket_size
+
+        self._boxes = []
+        # (bucket x, bucket y) => boxes touching that bucket
+        self._buckets = defaultdict(list)
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __iter__(self):
+        return iter(self._boxes)
+
+    def __getitem__(self, index):
+        return self._boxes[index]
+
+    def _bucket_range(self, box):
+        # Box.overlaps counts touching edges, so the far edge counts too
+        size = self.bucket_size
+        return (
+            range(box.x // size, (box.x + box.width) // size + 1),
+            range(box.y // size, (box.y + box.height) // size + 1))
+
+    def add(self, box):
+        self._boxes.append(box)
+        xs, ys = self._bucket_range(box)
+        buckets = self._buckets
+        for bx in xs:
+            for by in ys:
+                buckets[bx, by].append(box)
+
+    def overlapping(self, box):
+        """Returns every box that `overlaps` the given one."""
+        found = []
+        seen = set()
+        xs, ys = self._bucket_range(box)
+        buckets = self._buckets
+        for bx in xs:
+            for by in ys:
+                for other in buckets.get((bx, by), ()):
+                    if id(other) not in seen and box.overlaps(other):
+                        seen.add(id(other))
+                        found.append(other)
+        return found
+
+    def any_overlapping(self, box):
+        xs, ys = self._bucket_range(box)
+        buckets = self._buckets
+        for bx in xs:
+            for by in ys:
+                for other in buckets.get((bx, by), ()):
+                    if box.overlaps(other):
+                        return True
+        return False
+
+    def containing(self, x, y):
+        """Returns every box with the point (x, y) inside it."""
+        size = self.bucket_size
+        return [
+            box for box in self._buckets.get((x // size, y // size), ())
+            if box.x <= x < box.x + box.width and box.y <= y < box.y + box.height]
+
+    def nearest(self, x, y):
+        """Returns the box closest to the point (x, y), or `None` if there
+        aren't any.  Searches outwards a ring of buckets at a time.
+        """
+        if not self._boxes:
+            return None
+
+        size = self.bucket_size
+        buckets = self._buckets
+        cx, cy = x // size, y // size
+        best = None
+        best_distance = None
+        radius = 0
+        while True:
+            for bx in range(cx - radius, cx + radius + 1):
+                for by in range(cy - radius, cy + radius + 1):
+                    if max(abs(bx - cx), abs(by - cy)) != radius:
+                        continue
+                    for box in buckets.get((bx, by), ()):
+                        distance = box.distance_to(x, y)
+                        if best is None or distance < best_distance:
+                            best = box
+                            best_distance = distance
+
+            # Anything in a bucket further out is at least this far away
+            if best is not None and best_distance <= radius * size:
+                return best
+            radius += 1
+
 
 class WorldCanvas(object):
     """Life is my canvas, and I am its paintbrush.
@@ -162,7 +429,9 @@ class WorldCanvas(object):
     def __init__(self, width, height, offset_x=0, offset_y=0, parent=None):
         self.box = Box(offset_x, offset_y, width, height)
 
-        self.contents = []
+        self.contents = BoxIndex()
+        # Corridors are boxes too, but they're allowed to overlap anything
+        self.corridors = BoxIndex()
 
         if parent:
             # TODO this should really be a subclass instead of intertwining this logic
@@ -190,6 +459,24 @@ class WorldCanvas(object):
             self.subcanvas(midpoint, 0, width=self.box.width - midpoint, height=self.box.height),
         )
 
+    def partition_horiz(self, midpoint):
+        return (
+            self.subcanvas(0, 0, width=self.box.width, height=midpoint),
+            self.subcanvas(0, midpoint, width=self.box.width, height=self.box.height - midpoint),
+        )
+
+    def add_corridor(self, start, end):
+        """Add an L-shaped corridor between two (x, y) points: across from
+        the start, then up or down to the end.
+        """
+        if self._parent:
+            self._parent.add_corridor(start, end)
+            return
+
+        (x1, y1), (x2, y2) = start, end
+        self.corridors.add(Box(min(x1, x2), y1, abs(x2 - x1) + 1, 1))
+        self.corridors.add(Box(x2, min(y1, y2), 1, abs(y2 - y1) + 1))
+
     def add_box(self, box):
         """Add the given box as a container.  Must not overlap any existing
         boxes.
@@ -201,29 +488,44 @@ class WorldCanvas(object):
 
         assert box in self.box
 
-        assert all(not box.overlaps(other) for other in self.contents)
-
-        self.contents.append(box)
+        assert not self.contents.any_overlapping(box)
 
-    def to_map(self):
-        map = Map.from_fractor_canvas(self)
+        self.contents.add(box)
 
-        canvas = [[None] * self.box.width for _ in range(self.box.height)]
-
-        wall = things.Thing(type=things.wall)
-        for col, row in self.box:
-            canvas[row][col] = wall
-
-        floor = things.Thing(type=things.floor)
-        for box in self.contents:
-            for col, row in box:
-                canvas[row][col] = floor
-
-        map._architecture = canvas
+    def try_add_box(self, box):
+        """Adds the given box if it fits without overlapping anything, and
+        returns whether it did.  For generators that throw a lot of rooms at
+        the wall to see what sticks.
+        """
+        if self._parent:
+            return self._parent.try_add_box(box)
 
-        # Place an item
-        map.put(things.Thing(type=things.potion), Position(2, 3))
-        # Or two
-        map.put(things.Thing(type=things.newt), Position(2, 9))
+        if box not in self.box or self.contents.any_overlapping(box):
+            return False
+        self.contents.add(box)
+        return True
 
+    def nearest_box(self, x, y):
+        """Returns the room closest to the point (x, y)."""
+        if self._parent:
+            return self._parent.nearest_box(x, y)
+        return self.contents.nearest(x, y)
+
+    def to_map(self, seed=None):
+        architecture = ArchitectureLayer(
+            Size(rows=self.box.height, cols=self.box.width), fill=things.wall)
+        for box in itertools.chain(self.contents, self.corridors):
+            architecture.fill_rect(box.y, box.x, box.height, box.width, things.floor)
+
+        # Place the stairs: up in the first room, down in the last
+        first, last = self.contents[0], self.contents[-1]
+        entrance = Position(first.y + 1, first.x + 1)
+        architecture[entrance] = things.staircase_up
+        architecture[Position(last.y + last.height - 2, last.x + last.width - 2)] = things.staircase_down
+
+        # Corridors ought to have joined everything up already, but make sure
+        architecture.connect(entrance)
+
+        map = Map.from_architecture(architecture, seed=seed)
+        map.entrance = entrance
         return map
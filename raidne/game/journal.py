@@ -0,0 +1,272 @@
+"""Autosaving.
+
+Rewriting the whole game every few turns would cost time proportional to the
+size of the dungeon, so instead an autosave is a full saved game (the
+checkpoint) plus a journal of what's changed since, appended to every time the
+game is saved.  Each journal entry only holds the tiles touched since the
+previous entry, on the floors where anything happened at all; floors that have
+been generated or brought back into memory in the meantime are written whole,
+since there's nothing older to patch.
+
+Every so often the journal is folded back into a fresh checkpoint, so it
+doesn't grow forever and loading doesn't have to replay much.
+
+A journal file is a header naming the checkpoint it belongs to, then entries
+of a length, a CRC, and a zlib-compressed payload.  A journal for some other checkpoint is
+ignored, as is an entry cut short by a crash.
+"""
+import json
+import os
+import struct
+import zlib
+
+from raidne.game import storage
+from raidne.game.storage import StorageError
+
+_MAGIC = b'RDNJ'
+VERSION = 2
+
+# magic, version, checkpoint id
+_journal_header = struct.Struct('<4sBQ')
+# length, crc32
+_entry_header = struct.Struct('<II')
+# current depth, replay log bytes, message bytes
+_delta_header = struct.Struct('<iII')
+# depth, kind, length
+_floor_header = struct.Struct('<iBI')
+_count = struct.Struct('<I')
+_FULL = 0
+_TILES = 1
+
+def journal_path(path):
+    return path + '.journal'
+
+
+class Autosave(object):
+    """Keeps an autosave of `dungeon` at `path` up to date.  Call `save` as
+    often as you like; it's cheap when not much has happened.
+    """
+    # Fold the journal into a new checkpoint after this many entries, or once
+    # it's this many times the size of the checkpoint.  The second keeps the
+    # cost of checkpointing, which does depend on the size of the dungeon,
+    # in proportion to how much has been saved since the last one.
+    compact_every = 200
+    compact_ratio = 4
+
+    def __init__(self, dungeon, path):
+        self.dungeon = dungeon
+        self.path = path
+        self.journal_path = journal_path(path)
+
+        # depth => (map, MapChanges, RNG table as of the last save), for
+        # every floor whose changes are being followed
+        self._watched = {}
+        self._replay_offset = 0
+        self._entries = 0
+        self._base_size = 0
+
+        checkpoint = dungeon.save_metadata.get('checkpoint')
+        if checkpoint is not None and dungeon.journal_state is not None:
+            # Picking up where a loaded autosave left off
+            self._checkpoint = checkpoint
+            self._base_size = os.path.getsize(path)
+            self._entries, length = dungeon.journal_state
+            # Drop anything after the last good entry, or new entries would
+            # end up behind it
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(length)
+            self._watch_resident()
+        else:
+            self.checkpoint()
+
+    def _watch_resident(self):
+        """Starts afresh following changes to every floor in memory."""
+        for map, changes, _ in self._watched.values():
+            map.unwatch(changes)
+        self._watched.clear()
+        for map in self.dungeon.floors.resident():
+            self._watch(map)
+        self._replay_offset = len(self.dungeon.replay_log)
+
+    def _watch(self, map):
+        self._watched[map.depth] = map, map.watch(), map.rng.getstate()[1]
+        map.schedule.changed.clear()
+
+    def checkpoint(self):
+        """Writes the whole game out, and starts a new, empty journal."""
+        self._checkpoint = int.from_bytes(os.urandom(8), 'little')
+        storage.save_dungeon(self.dungeon, self.path, checkpoint=self._checkpoint)
+        self._base_size = os.path.getsize(self.path)
+
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(_journal_header.pack(_MAGIC, VERSION, self._checkpoint))
+        os.replace(temp_path, self.journal_path)
+        self._entries = 0
+
+        self._watch_resident()
+
+    def save(self):
+        """Appends everything that's changed since the last save to the
+        journal, compacting it if it's getting long.
+        """
+        entry = zlib.compress(self._delta(), 1)
+        with open(self.journal_path, 'ab') as f:
+            f.write(_entry_header.pack(len(entry), zlib.crc32(entry)))
+            f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+        self._entries += 1
+
+        if (self._entries >= self.compact_every or
+                os.path.getsize(self.journal_path) > self.compact_ratio * self._base_size):
+            self.checkpoint()
+
+    def _delta(self):
+        dungeon = self.dungeon
+        floors = dungeon.floors
+        player = dungeon.player
+
+        out = bytearray()
+        replay = dungeon.replay_log.actions_bytes(self._replay_offset)
+        self._replay_offset += len(replay)
+        messages = json.dumps(dungeon.pending_messages()).encode('utf8')
+        out += _delta_header.pack(
+            dungeon.current_floor.depth, len(replay), len(messages))
+        out += replay
+        out += messages
+
+        out += storage.dump_moving_things(dungeon.moving_things)
+
+        records = []
+        resident = {map.depth: map for map in floors.resident()}
+        for depth, (map, changes, _) in list(self._watched.items()):
+            if resident.get(depth) is map:
+                continue
+            # Paged out since the last save, so whatever it looked like last
+            # is wherever the store put it.  (If it's been brought back in
+            # since, it's written whole below.)
+            map.unwatch(changes)
+            del self._watched[depth]
+            if depth not in resident and (changes or map.schedule.changed):
+                records.append((depth, _FULL, floors.floor_bytes(depth, compress=True)))
+
+        for depth, map in sorted(resident.items()):
+            watched = self._watched.get(depth)
+            if watched is None:
+                records.append((depth, _FULL, storage.dump_floor(map, player=player, compress=True)))
+                self._watch(map)
+                continue
+
+            _, changes, rng_words = watched
+            rescheduled = map.schedule.changed
+            if not changes and not changes.remembered and not rescheduled:
+                continue
+            positions = set(changes.positions)
+            positions.update(map.position_of(actor) for actor in rescheduled)
+            records.append((depth, _TILES, storage.dump_tiles(
+                map, sorted(positions), player=player, rescheduled=rescheduled,
+                rng_words=rng_words, remembered=changes.remembered)))
+            changes.clear()
+            rescheduled.clear()
+            self._watched[depth] = map, changes, map.rng.getstate()[1]
+
+        out += _count.pack(len(records))
+        for depth, kind, data in records:
+            out += _floor_header.pack(depth, kind, len(data))
+            out += data
+
+        return bytes(out)
+
+
+def _entries(path, checkpoint):
+    """Yields the payload of every intact entry in the journal at `path`, if
+    it belongs to `checkpoint`, along with the offset just past it.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+
+    if len(data) < _journal_header.size:
+        return
+    magic, version, journal_checkpoint = _journal_header.unpack_from(data)
+    if magic != _MAGIC:
+        raise StorageError("Not an autosave journal")
+    if version != VERSION:
+        raise StorageError("Can't read journal version {0}".format(version))
+    if journal_checkpoint != checkpoint:
+        # Left over from an older checkpoint; the save is newer than all of it
+        return
+
+    offset = _journal_header.size
+    while offset + _entry_header.size <= len(data):
+        length, crc = _entry_header.unpack_from(data, offset)
+        offset += _entry_header.size
+        entry = data[offset:offset + length]
+        if len(entry) < length or zlib.crc32(entry) != crc:
+            # Torn write; everything before it is still good
+            return
+        offset += length
+        yield zlib.decompress(entry), offset
+
+def load_autosave(cls, path, prefetch=True):
+    """Loads the checkpoint at `path` and replays its journal on top.  Returns
+    an instance of the Dungeon subclass `cls`.  `prefetch` is as for
+    `Dungeon`.
+    """
+    # Nothing's prefetched until the journal says where the player ended up
+    dungeon = storage.load_dungeon(cls, path, prefetch=False)
+    checkpoint = dungeon.save_metadata.get('checkpoint')
+    floors = dungeon.floors
+
+    depth = dungeon.current_floor.depth
+    player = dungeon.player
+    applied = 0
+    end = None
+    for entry, end in _entries(journal_path(path), checkpoint):
+        depth, replay_length, messages_length = _delta_header.unpack_from(entry)
+        offset = _delta_header.size
+        dungeon.replay_log.extend(entry[offset:offset + replay_length])
+        offset += replay_length
+        dungeon.restore_messages(json.loads(
+            entry[offset:offset + messages_length].decode('utf8')))
+        offset += messages_length
+
+        # Anything in transit was either delivered to a floor in this entry,
+        # or is listed again
+        moving, offset = storage.load_moving_things(entry, offset)
+        dungeon.moving_things.clear()
+
+        count, = _count.unpack_from(entry, offset)
+        offset += _count.size
+        for _ in range(count):
+            floor_depth, kind, length = _floor_header.unpack_from(entry, offset)
+            offset += _floor_header.size
+            data = memoryview(entry)[offset:offset + length]
+            offset += length
+
+            if kind == _FULL and floor_depth == depth:
+                map, found = storage.load_floor(data)
+                floors.replace(map)
+                player = found or player
+            elif kind == _FULL:
+                floors.add_source(floor_depth, data)
+            else:
+                found, _ = storage.load_tiles(floors[floor_depth], data)
+                player = found or player
+
+        for moving_depth, thing, position in moving:
+            dungeon.moving_things[moving_depth].append((thing, position))
+        applied += 1
+
+    dungeon.player = player
+    dungeon.prefetch = prefetch
+    dungeon.enter_floor(depth)
+    if player not in dungeon.current_floor:
+        raise StorageError("Autosave journal lost the player")
+    if end is not None:
+        # So an Autosave can carry on appending to the same journal
+        dungeon.journal_state = applied, end
+    return dungeon
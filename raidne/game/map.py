@@ -1,10 +1,16 @@
 """Fairly dumb representation of dungeon geometry."""
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
+from functools import partial
+import random
 
 import raidne.exceptions as exceptions
 from raidne.game import things
-from raidne.util import Offset, Position, Size
+from raidne.game import connectivity
+from raidne.game.pathing import DIRECTIONS, DistanceMap, PathCache
+from raidne.game.schedule import Schedule
+from raidne.game.vision import FieldOfView
+from raidne.util import Offset, Position
 
 class Map(object):
     """Geometry of a dungeon floor.  Functions both as structure (architectural
@@ -17,22 +23,55 @@ class Map(object):
             raise TypeError("Can't instantiate Map directly; please use a fractor")
 
     @classmethod
-    def from_fractor_canvas(cls, canvas):
+    def from_architecture(cls, architecture, seed=None):
+        """Builds a map around a fully-drawn `ArchitectureLayer`.  `seed`
+        seeds the map's own random number generator, which is used by
+        everything that happens on it.
+        """
         self = cls(_internal_call=True)
-        self.size = Size(rows=canvas.box.height, cols=canvas.box.width)
-        #rows=len(canvas), cols=len(canvas[0]))
+        self.size = architecture.size
+        self.rng = random.Random(seed)
+
+        # Which floor of the dungeon this is, if it's part of one
+        self.depth = None
+        # Where things arriving from upstairs end up
+        self.entrance = None
 
         # There are three layers of objects on any given tile:
         # - exactly one architecture,
         # - zero or more items, and
         # - zero or one creatures.
-        # The latter two are taken care of with two sparse dictionaries and a
-        # lot of type-checking.
-        self._architecture = canvas
+        # The first is a flat array of type codes; the latter two are taken
+        # care of with two sparse dictionaries and a lot of type-checking.
+        self._architecture = architecture
         self._items = defaultdict(list)
         self._critters = dict()
 
-        # TODO assert architecture is populated fully, somewhere
+        # Reverse index of everything in the two sparse layers, mapping each
+        # thing (by identity) to a (position, layer) pair, where layer is one
+        # of the two dicts above.  Keeps find() and friends constant-time.
+        self._index = dict()
+
+        # Turn order for every creature on this floor.  put() and remove()
+        # keep it in sync with the creature layer.
+        self.schedule = Schedule()
+        # Optional columnar copy of the creatures' stats; see
+        # use_creature_store()
+        self.creatures = None
+
+        # Everyone who wants to hear about changes to this map; see watch()
+        self._watchers = []
+
+        # Shared distance maps, keyed by the thing they lead to
+        self._distance_maps = {}
+        # Created on demand by find_path()
+        self._path_cache = None
+        # Fields of view, keyed by viewer.  Unlike distance maps, these stick
+        # around when the viewer leaves, so they remember what they've seen
+        self._fields_of_view = {}
+        # What was seen here before the floor was last saved, waiting for
+        # someone to look again; see remember()
+        self._saved_memory = set()
 
         return self
 
@@ -41,13 +80,112 @@ class Map(object):
         counts things actually on the map proper: inventories and containers
         and so forth are not inspected.
         """
-        # TODO index or whatever, then swap these impls
-        try:
-            self.find(thing)
-            return True
-        except ValueError:
-            return False
+        return thing in self._index
+
+
+    def use_creature_store(self):
+        """Starts keeping every creature's stats on this floor in a
+        `CreatureStore`, for whole-floor operations.  Returns the store.
+        """
+        if self.creatures is None:
+            from raidne.game.creatures import CreatureStore
+            store = CreatureStore()
+            for position, creature in self._critters.items():
+                ready = self.schedule.ready_time(creature) if creature in self.schedule else 0
+                store.add(creature, position, ready)
+            self.creatures = store
+            self.schedule.store = store
+        return self.creatures
+
+    def watch(self):
+        """Returns a `MapChanges` that will collect every position touched on
+        this map from now on, until passed to `unwatch`.
+        """
+        changes = MapChanges()
+        self._watchers.append(changes)
+        return changes
+
+    def unwatch(self, changes):
+        self._watchers.remove(changes)
+
+    def _touch(self, position, architecture=False):
+        for changes in self._watchers:
+            changes.positions.add(position)
+            if architecture:
+                changes.architecture.add(position)
+
+    def _touch_memory(self, positions):
+        """Called by a `FieldOfView` when it remembers new `positions`."""
+        for changes in self._watchers:
+            changes.remembered.update(positions)
+
+    def architecture_types(self, row, start=0, stop=None):
+        """Returns the architecture type in each column of the given row, or
+        just the columns from `start` to `stop`, as a list.
+        """
+        by_code = things.Architecture.by_code
+        return [by_code[code] for code in self._architecture.row_codes(row, start, stop)]
 
+    def topmost_types(self, row, start=0, stop=None):
+        """Returns the type of the topmost thing in each column of the given
+        row (or part of it, as with `architecture_types`), as a list.  A
+        faster way to get at `Tile.topmost` for a lot of tiles at once.
+        """
+        if stop is None:
+            stop = self.size.cols
+        types = self.architecture_types(row, start, stop)
+
+        critters = self._critters
+        items = self._items
+        if critters or items:
+            for col in range(start, stop):
+                # Positions hash and compare like plain tuples
+                key = row, col
+                if key in critters:
+                    types[col - start] = critters[key].type
+                elif key in items:
+                    types[col - start] = items[key][-1].type
+
+        return types
+
+    def is_open(self, position):
+        """Whether a creature could step onto `position` right now: it's on
+        the map, not solid, and not already occupied.
+        """
+        return (
+            position in self.size and
+            not self._architecture.solid_at(position.row, position.col) and
+            position not in self._critters)
+
+    def nearest_open(self, position):
+        """Returns the closest position to `position` that `is_open`, or
+        `None` if there's nowhere at all.
+        """
+        seen = {position}
+        queue = deque([position])
+        while queue:
+            position = queue.popleft()
+            if self.is_open(position):
+                return position
+            for drow, dcol in DIRECTIONS:
+                neighbor = Position(position.row + drow, position.col + dcol)
+                if neighbor not in seen and neighbor in self.size:
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+        return None
+
+    def iter_items(self):
+        """Yields (position, item) for every item on the floor, bottom to top.
+        """
+        for position, thinglist in self._items.items():
+            for item in thinglist:
+                yield position, item
+
+    def _touch_thing(self, thing):
+        """Marks the tile `thing` is on as changed, e.g. because its health
+        changed.
+        """
+        self._touch(self.position_of(thing))
 
     def tile(self, position):
         """Returns a little wrapper object representing this spot on the map.
@@ -57,48 +195,162 @@ class Map(object):
 
     def find(self, thing):
         """Finds the given thing.  Doesn't work on architecture."""
-        # TODO index me or whatever
-        for position, critter in self._critters.items():
-            if thing is critter:
-                return self.tile(position)
-        for position, thinglist in self._items.items():
-            if thing in thinglist:
-                return self.tile(position)
-        raise ValueError("No such thing on this map")
+        return Tile(self, self.position_of(thing))
+
+    def position_of(self, thing):
+        """Like `find`, but returns just the position."""
+        try:
+            return self._index[thing][0]
+        except KeyError:
+            raise ValueError("No such thing on this map")
 
     def distance_between(self, a, b):
         """Returns some kinda object representing the space between two things.
         """
-        # XXX this should return a useful object that can be used for pathing
-        # etc later
-        tile_a = self.find(a)
-        tile_b = self.find(b)
+        # XXX this is just the straight-line offset; see find_path() for an
+        # actual route
+        return self.position_of(b) - self.position_of(a)
+
+    def distance_map(self, goal):
+        """Returns an up-to-date `DistanceMap` leading to the `goal` thing.
+        Every caller asking about the same goal shares the same one, so it's
+        only recomputed when the goal moves or the floor changes.
+        """
+        if goal not in self._index:
+            raise ValueError("No such thing on this map")
+
+        distance_map = self._distance_maps.get(goal)
+        if distance_map is None:
+            distance_map = self._distance_maps[goal] = DistanceMap(self, goal)
+        distance_map.refresh()
+        return distance_map
+
+    def field_of_view(self, viewer):
+        """Returns an up-to-date `FieldOfView` for the `viewer` thing."""
+        if viewer not in self._index:
+            raise ValueError("No such thing on this map")
+
+        field_of_view = self._fields_of_view.get(viewer)
+        if field_of_view is None:
+            field_of_view = self._new_field_of_view(viewer)
+        field_of_view.refresh()
+        return field_of_view
+
+    def _new_field_of_view(self, viewer):
+        field_of_view = self._fields_of_view[viewer] = FieldOfView(self, viewer)
+        field_of_view.remembered = self._saved_memory
+        self._saved_memory = set()
+        return field_of_view
+
+    def remembered(self):
+        """Returns every position anyone has seen on this map, as bare (row,
+        col) tuples.
+        """
+        remembered = set(self._saved_memory)
+        for field_of_view in self._fields_of_view.values():
+            remembered.update(field_of_view.remembered)
+        return remembered
+
+    def remember(self, remembered, viewer=None):
+        """Restores what was seen on this map, as returned by `remembered`,
+        on top of whatever's remembered already.  It goes to `viewer` if
+        given, otherwise to whoever has already looked around here -- or,
+        failing that, whoever looks first.
+        """
+        if viewer is not None:
+            field_of_view = self._fields_of_view.get(viewer)
+            if field_of_view is None:
+                field_of_view = self._new_field_of_view(viewer)
+            # Anyone else who looked but is gone now was an older copy of
+            # the viewer, so the viewer inherits what they saw
+            for other in list(self._fields_of_view):
+                if other is not viewer and other not in self._index:
+                    old = self._fields_of_view.pop(other)
+                    old.close()
+                    field_of_view.remembered.update(old.remembered)
+
+        if self._fields_of_view:
+            for field_of_view in self._fields_of_view.values():
+                field_of_view.remembered.update(remembered)
+        else:
+            self._saved_memory.update(remembered)
 
-        return tile_b.position - tile_a.position
+    def find_path(self, start, goal):
+        """Returns a `Path` from `start` to `goal`, which may be positions or
+        things on this map, or `None` if there's no way to get there.  Paths
+        are cached and shared until the architecture they cross changes.
+        """
+        if not isinstance(start, Position):
+            start = self.position_of(start)
+        if not isinstance(goal, Position):
+            goal = self.position_of(goal)
+
+        if self._path_cache is None:
+            self._path_cache = PathCache(self)
+        return self._path_cache.find(start, goal)
 
     def put(self, thing, position):
         """Put the given `thing` somewhere on the map."""
         assert isinstance(position, Position)
         assert position in self.size
-        # XXX assert thing not already on the map
+        assert thing not in self._index
         # XXX possibly move the collision stuff here, instead of in move()?
-        if thing.isa(things.Creature):
+        categories = thing._type.categories
+        if categories & things.CREATURE:
             assert position not in self._critters
             self._critters[position] = thing
-        elif thing.isa(things.Item):
+            self._index[thing] = position, self._critters
+            if self.creatures is not None:
+                self.creatures.add(thing, position)
+            self.schedule.add(thing)
+            health = getattr(thing, 'health', None)
+            if health is not None:
+                health.watcher = partial(self._touch_thing, thing)
+        elif categories & things.ITEM:
             self._items[position].append(thing)
+            self._index[thing] = position, self._items
         else:
             raise ValueError("Don't know what that thing is")
 
+        self._touch(position)
+
     def remove(self, thing):
-        position = self.find(thing).position
-        if thing.isa(things.Creature):
+        try:
+            position, layer = self._index.pop(thing)
+        except KeyError:
+            raise ValueError("No such thing on this map")
+
+        self._unlink(thing, position, layer)
+        if layer is self._critters:
+            self.schedule.discard(thing)
+            if self.creatures is not None:
+                self.creatures.remove(thing)
+            health = getattr(thing, 'health', None)
+            if health is not None:
+                health.watcher = None
+
+        distance_map = self._distance_maps.pop(thing, None)
+        if distance_map is not None:
+            distance_map.close()
+
+        self._touch(position)
+
+    def _unlink(self, thing, position, layer):
+        """Takes `thing` out of its layer, without touching the index or the
+        schedule.
+        """
+        if layer is self._critters:
             assert self._critters[position] is thing
             del self._critters[position]
-        elif thing.isa(things.Item):
-            self._items[position].remove(thing)
         else:
-            raise ValueError("Don't know what that thing is")
+            thinglist = self._items[position]
+            # list.remove() compares with ==; we want identity
+            for i, item in enumerate(thinglist):
+                if item is thing:
+                    del thinglist[i]
+                    break
+            if not thinglist:
+                del self._items[position]
 
     def move(self, actor, place):
         """Moves the given thing somewhere else.  `place` can be a position or
@@ -117,15 +369,136 @@ class Map(object):
         # XXX Return something useful?
         # XXX Should this fire triggers on the target tile, or is that the
         # caller's responsibility?
-        old_position = self.find(actor).position
+        old_position = self.position_of(actor)
         new_position = place.relative_to(old_position)
         assert new_position in self.size
         if old_position == new_position:
             return
 
-        # Perform the move
-        self.remove(actor)
-        self.put(actor, new_position)
+        # Perform the move.  Done by hand rather than with remove() and put(),
+        # so a creature keeps its place in the schedule
+        layer = self._index[actor][1]
+        self._unlink(actor, old_position, layer)
+        if layer is self._critters:
+            assert new_position not in self._critters
+            self._critters[new_position] = actor
+            if self.creatures is not None:
+                self.creatures.move(actor, new_position)
+        else:
+            self._items[new_position].append(actor)
+        self._index[actor] = new_position, layer
+
+        self._touch(old_position)
+        self._touch(new_position)
+
+    def set_architecture(self, position, architecture):
+        """Rebuild part of the floor.  `architecture` is an `Architecture`
+        type, or a Thing of one.
+        """
+        assert position in self.size
+        self._architecture[position] = architecture
+        self._touch(position, architecture=True)
+
+class MapChanges(object):
+    """Collects the positions touched on a map since it was last cleared.
+    Anything that caches per-position state, like the renderer, can keep one
+    of these around to find out what's stale.
+    """
+    def __init__(self):
+        # Every position whose contents changed in any way
+        self.positions = set()
+        # Just the positions whose architecture changed
+        self.architecture = set()
+        # Positions someone remembers now but didn't before, as bare (row,
+        # col) tuples.  Nothing on the map itself changed, so these don't
+        # count towards truthiness
+        self.remembered = set()
+
+    def __bool__(self):
+        return bool(self.positions)
+
+    def clear(self):
+        self.positions.clear()
+        self.architecture.clear()
+        self.remembered.clear()
+
+
+class ArchitectureLayer(object):
+    """The architecture of a floor, stored as a flat `bytearray` of
+    `Architecture.type_code`s in row-major order.  Indexing by position
+    returns the shared `Thing` for that type.
+    """
+    def __init__(self, size, fill=things.wall):
+        self.size = size
+        self._codes = bytearray([fill.type_code]) * (size.rows * size.cols)
+
+    @classmethod
+    def from_bytes(cls, size, data):
+        self = cls.__new__(cls)
+        self.size = size
+        self._codes = bytearray(data)
+        assert len(self._codes) == size.rows * size.cols
+        return self
+
+    def to_bytes(self):
+        return bytes(self._codes)
+
+    def __getitem__(self, position):
+        code = self._codes[position.row * self.size.cols + position.col]
+        return things.Architecture.by_code[code].singleton
+
+    def __setitem__(self, position, architecture):
+        """Accepts either an `Architecture` type or a Thing of one."""
+        if isinstance(architecture, things.Thing):
+            architecture = architecture._type
+        self._codes[position.row * self.size.cols + position.col] = architecture.type_code
+
+    def type_at(self, position):
+        return things.Architecture.by_code[
+            self._codes[position.row * self.size.cols + position.col]]
+
+    def solid_at(self, row, col):
+        """Whether the architecture at (`row`, `col`) is solid.  Takes bare
+        coordinates, since it's mostly for tight loops.
+        """
+        return things.Architecture.solid_codes[self._codes[row * self.size.cols + col]]
+
+    def row_codes(self, row, start=0, stop=None):
+        """Returns the type codes for a single row, or the columns from
+        `start` to `stop` of it, as a `memoryview`.
+        """
+        if stop is None:
+            stop = self.size.cols
+        offset = row * self.size.cols
+        return memoryview(self._codes)[offset + start:offset + stop]
+
+    def regions(self):
+        """Returns the `connectivity.Regions` of this floor."""
+        return connectivity.Regions(self._codes, self.size.rows, self.size.cols)
+
+    def connect(self, start=None):
+        """Digs corridors until every open tile can be reached from `start`.
+        See `connectivity.connect`.
+        """
+        return connectivity.connect(self._codes, self.size.rows, self.size.cols, start)
+
+    def fill_rect(self, top, left, height, width, architecture):
+        """Sets a whole rectangle to the same architecture, one row slice at a
+        time.
+        """
+        assert 0 <= top and top + height <= self.size.rows
+        assert 0 <= left and left + width <= self.size.cols
+        if isinstance(architecture, things.Thing):
+            architecture = architecture._type
+
+        codes = self._codes
+        cols = self.size.cols
+        run = bytes([architecture.type_code]) * width
+        start = top * cols + left
+        for _ in range(height):
+            codes[start:start + width] = run
+            start += cols
+
 
 class Tile(namedtuple('Tile', ('map', 'position'))):
     """Transient class representing the contents of a single tile.  Meant for
@@ -142,11 +515,11 @@ class Tile(namedtuple('Tile', ('map', 'position'))):
         if self.position in self.map._critters:
             yield self.map._critters[self.position]
 
-        for item in reversed(self.map._items[self.position]):
+        for item in reversed(self.map._items.get(self.position, ())):
             yield item
 
         if include_architecture:
-            yield self.map._architecture[self.position.row][self.position.col]
+            yield self.map._architecture[self.position]
 
     def __eq__(self, other):
         return self.map == other.map and self.position == other.position
@@ -162,12 +535,12 @@ class Tile(namedtuple('Tile', ('map', 'position'))):
     @property
     def architecture(self):
         """The architecture here."""
-        return self.map._architecture[self.position.row][self.position.col]
+        return self.map._architecture[self.position]
 
     @property
     def items(self):
         """Returns the items here, in order from top to bottom."""
-        return list(reversed(self.map._items[self.position]))
+        return list(reversed(self.map._items.get(self.position, ())))
 
     @property
     def creature(self):
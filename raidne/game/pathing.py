@@ -0,0 +1,311 @@
+"""Getting from here to there.
+
+Distances and paths only care about architecture; creatures get in the way
+too, but they move around too much to be worth routing around ahead of time.
+Callers should check that the next step is actually free before taking it.
+"""
+from collections import deque
+import heapq
+
+from raidne.util import Position
+
+# Creatures only move orthogonally, for now
+DIRECTIONS = ((0, +1), (0, -1), (+1, 0), (-1, 0))
+
+class DistanceMap(object):
+    """Number of steps from every nearby open tile to some goal, also known
+    as a Dijkstra map.  Anything heading for the goal can just keep stepping
+    downhill, so one of these can be shared by every creature chasing the same
+    thing.
+
+    Only tiles within `horizon` steps of the goal are mapped; anything farther
+    out is too far away to care.
+
+    Call `refresh` to bring the map up to date.  If the goal has moved, the
+    whole thing is recomputed; if only some of the architecture has changed,
+    just the affected area is repaired.
+    """
+    horizon = 40
+
+    def __init__(self, map, goal, horizon=None):
+        self.map = map
+        self.goal = goal
+        if horizon is not None:
+            self.horizon = horizon
+
+        # Keyed by (row, col); Positions work for lookups too
+        self._distances = {}
+        self._origin = None
+        self._changes = map.watch()
+
+    def close(self):
+        """Stops tracking changes to the map."""
+        self.map.unwatch(self._changes)
+
+    def __getitem__(self, position):
+        """Distance from `position` to the goal, or `None` if it's out of
+        reach.
+        """
+        return self._distances.get(position)
+
+    def refresh(self):
+        origin = self.map.position_of(self.goal)
+        if origin != self._origin:
+            self._origin = origin
+            self._flood()
+        elif self._changes.architecture:
+            self._repair(self._changes.architecture)
+        self._changes.clear()
+
+    def downhill(self, position):
+        """Returns the neighbors of `position` that are closer to the goal,
+        closest first.
+        """
+        distances = self._distances
+        here = distances.get(position)
+        if here is None:
+            return []
+
+        row, col = position
+        steps = []
+        for drow, dcol in DIRECTIONS:
+            there = distances.get((row + drow, col + dcol))
+            if there is not None and there < here:
+                steps.append((there, Position(row + drow, col + dcol)))
+        steps.sort()
+        return [step for _, step in steps]
+
+    def _open_neighbors(self, row, col):
+        size = self.map.size
+        architecture = self.map._architecture
+        for drow, dcol in DIRECTIONS:
+            nrow = row + drow
+            ncol = col + dcol
+            if (0 <= nrow < size.rows and 0 <= ncol < size.cols
+                    and not architecture.solid_at(nrow, ncol)):
+                yield nrow, ncol
+
+    def _flood(self):
+        """Recomputes everything from scratch, with a plain breadth-first
+        search out from the goal.
+        """
+        distances = self._distances = {}
+        origin = tuple(self._origin)
+        distances[origin] = 0
+
+        horizon = self.horizon
+        queue = deque([origin])
+        while queue:
+            cell = queue.popleft()
+            distance = distances[cell] + 1
+            if distance > horizon:
+                continue
+            for neighbor in self._open_neighbors(*cell):
+                if neighbor not in distances:
+                    distances[neighbor] = distance
+                    queue.append(neighbor)
+
+    def _repair(self, changed):
+        """Fixes up the map after the architecture at the `changed` positions
+        has been altered.
+        """
+        distances = self._distances
+        architecture = self.map._architecture
+
+        # First throw away anything that might have depended on the changed
+        # tiles: every tile reachable from them by walking strictly uphill
+        stale = set()
+        queue = deque()
+        for position in changed:
+            cell = tuple(position)
+            if cell in distances and cell not in stale:
+                stale.add(cell)
+                queue.append((cell, distances[cell]))
+        while queue:
+            (row, col), distance = queue.popleft()
+            for drow, dcol in DIRECTIONS:
+                neighbor = row + drow, col + dcol
+                if neighbor not in stale and distances.get(neighbor, -1) > distance:
+                    stale.add(neighbor)
+                    queue.append((neighbor, distances[neighbor]))
+        if tuple(self._origin) in stale:
+            # Somebody built something on top of the goal?  Whatever
+            self._flood()
+            return
+        for cell in stale:
+            del distances[cell]
+
+        # Then reseed those tiles, plus any that have just opened up, from
+        # whatever surviving neighbors they have, and let Dijkstra fill in the
+        # rest
+        heap = []
+        candidates = stale.union(tuple(position) for position in changed)
+        for row, col in candidates:
+            if architecture.solid_at(row, col):
+                continue
+            best = None
+            for neighbor in self._open_neighbors(row, col):
+                distance = distances.get(neighbor)
+                if distance is not None and (best is None or distance < best):
+                    best = distance
+            if best is not None and best + 1 <= self.horizon:
+                heapq.heappush(heap, (best + 1, (row, col)))
+
+        while heap:
+            distance, cell = heapq.heappop(heap)
+            if distances.get(cell, distance + 1) <= distance:
+                continue
+            distances[cell] = distance
+            if distance + 1 > self.horizon:
+                continue
+            for neighbor in self._open_neighbors(*cell):
+                if distances.get(neighbor, distance + 2) > distance + 1:
+                    heapq.heappush(heap, (distance + 1, neighbor))
+
+
+class Path(object):
+    """A route across a map: a list of positions, starting where you are and
+    ending at the goal.  Paths are immutable, and a path starting partway
+    along another one shares its list of steps.
+    """
+
+    def __init__(self, steps, offset=0):
+        self._steps = steps
+        self._offset = offset
+
+    @property
+    def start(self):
+        return self._steps[self._offset]
+
+    @property
+    def goal(self):
+        return self._steps[-1]
+
+    def __len__(self):
+        """Number of steps it takes to walk this path."""
+        return len(self._steps) - self._offset - 1
+
+    def __iter__(self):
+        return iter(self._steps[self._offset:])
+
+    def __contains__(self, position):
+        return position in self._steps[self._offset:]
+
+    def next_step(self):
+        """Returns where to go first, or `None` if we're already there."""
+        if len(self) == 0:
+            return None
+        return self._steps[self._offset + 1]
+
+    def suffix(self, position):
+        """Returns the rest of this path, starting from `position`."""
+        return type(self)(self._steps, self._steps.index(position, self._offset))
+
+
+def find_path(map, start, goal, limit=None):
+    """Runs A* from `start` to `goal`, returning a `Path` or `None` if there's
+    no way through.  At most `limit` tiles are examined, if given.
+    """
+    start = tuple(start)
+    goal = tuple(goal)
+    goal_row, goal_col = goal
+
+    # Ties on total cost are broken by the heuristic, so the search prefers
+    # tiles nearer the goal and barrels through open rooms in a straight line
+    # rather than fanning out
+    heuristic = abs(goal_row - start[0]) + abs(goal_col - start[1])
+    heap = [(heuristic, heuristic, start)]
+    came_from = {start: None}
+    costs = {start: 0}
+    examined = 0
+
+    size = map.size
+    architecture = map._architecture
+    while heap:
+        _, _, cell = heapq.heappop(heap)
+        if cell == goal:
+            break
+
+        examined += 1
+        if limit is not None and examined > limit:
+            return None
+
+        row, col = cell
+        cost = costs[cell] + 1
+        for drow, dcol in DIRECTIONS:
+            nrow = row + drow
+            ncol = col + dcol
+            neighbor = nrow, ncol
+            if (not (0 <= nrow < size.rows and 0 <= ncol < size.cols)
+                    or architecture.solid_at(nrow, ncol)):
+                continue
+            if cost < costs.get(neighbor, cost + 1):
+                costs[neighbor] = cost
+                came_from[neighbor] = cell
+                heuristic = abs(goal_row - nrow) + abs(goal_col - ncol)
+                heapq.heappush(heap, (cost + heuristic, heuristic, neighbor))
+    else:
+        return None
+
+    steps = []
+    cell = goal
+    while cell is not None:
+        steps.append(Position(*cell))
+        cell = came_from[cell]
+    steps.reverse()
+    return Path(steps)
+
+
+class PathCache(object):
+    """Remembers paths found on a map, so creatures headed to the same place
+    can share them: anyone standing on a known path to their goal just follows
+    the rest of it.
+
+    Architecture changes are picked up through the map's change tracking.
+    Paths through anything that's become solid are dropped; if anything has
+    opened up, everything is dropped, since there might be shortcuts now.
+    """
+    # Paths remembered per goal
+    paths_per_goal = 16
+
+    def __init__(self, map):
+        self.map = map
+        self._paths = {}
+        self._changes = map.watch()
+
+    def close(self):
+        self.map.unwatch(self._changes)
+
+    def _invalidate(self):
+        changed = self._changes.architecture
+        if not changed:
+            self._changes.clear()
+            return
+
+        architecture = self.map._architecture
+        if any(not architecture.solid_at(*position) for position in changed):
+            self._paths.clear()
+        else:
+            for goal, paths in list(self._paths.items()):
+                paths[:] = [
+                    path for path in paths
+                    if not any(position in changed for position in path)]
+                if not paths:
+                    del self._paths[goal]
+        self._changes.clear()
+
+    def find(self, start, goal):
+        self._invalidate()
+
+        paths = self._paths.setdefault(goal, [])
+        for path in paths:
+            if start in path:
+                return path.suffix(start)
+
+        path = find_path(self.map, start, goal)
+        if path is None:
+            return None
+
+        paths.insert(0, path)
+        del paths[self.paths_per_goal:]
+        return path
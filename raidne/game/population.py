@@ -0,0 +1,155 @@
+"""Filling freshly generated floors with monsters and items.
+
+What to put down comes from a `SpawnTable`, which is just a weighted list of
+`ThingType`s.  Where to put it comes from `scatter`, which picks free floor
+tiles at random but never too close together -- a Poisson-disk sample -- so
+things end up spread out rather than in clumps.  Nearby picks are found with a
+spatial hash, so placing thousands of things doesn't mean comparing every
+pair.
+"""
+from bisect import bisect
+import itertools
+import math
+
+from raidne.game import things
+from raidne.util import Position
+
+class SpawnTable(object):
+    """Weighted choice between thing types."""
+    def __init__(self, entries):
+        entries = list(entries)
+        assert entries
+        self.types = [thing_type for thing_type, _ in entries]
+        self._cumulative = list(itertools.accumulate(weight for _, weight in entries))
+
+    def choose(self, rng):
+        return self.types[bisect(self._cumulative, rng.random() * self._cumulative[-1])]
+
+    def __iter__(self):
+        return iter(self.types)
+
+default_spawn_table = SpawnTable([
+    (things.newt, 2),
+    (things.potion, 1),
+])
+
+
+def free_tiles(map, architecture=things.floor):
+    """Returns the flat index (row * cols + col) of every tile of the given
+    architecture that has nothing on it.
+    """
+    cols = map.size.cols
+    wanted = bytes(1 if code == architecture.type_code else 0 for code in range(256))
+    free = []
+    for row in range(map.size.rows):
+        codes = bytes(map._architecture.row_codes(row)).translate(wanted)
+        offset = row * cols
+        position = 0
+        while True:
+            start = codes.find(1, position)
+            if start < 0:
+                break
+            end = codes.find(0, start)
+            if end < 0:
+                end = cols
+            free.extend(range(offset + start, offset + end))
+            position = end
+
+    if map._index:
+        taken = {position.row * cols + position.col for position, _ in map._index.values()}
+        free = [index for index in free if index not in taken]
+    return free
+
+def scatter(map, count, rng, min_distance=None, avoid=(), architecture=things.floor):
+    """Picks up to `count` free tiles of the given architecture, each at least
+    `min_distance` apart, and that far from anything in `avoid` too.  If no
+    distance is given, one is picked so that `count` things would spread
+    evenly over the floor; if they won't all fit, the distance is halved until
+    they do.
+
+    Returns a list of positions.
+    """
+    free = free_tiles(map, architecture)
+    if not free or count <= 0:
+        return []
+    count = min(count, len(free))
+    cols = map.size.cols
+
+    if min_distance is None:
+        # A Poisson-disk sample packs a little looser than a grid would
+        min_distance = max(1, int(math.sqrt(len(free) / count) * 0.7))
+
+    # Positions to avoid are treated like picks that have already been made,
+    # but aren't returned
+    avoid = [row * cols + col for row, col in avoid]
+    chosen = []
+    distance = min_distance
+    while distance > 1:
+        # Spatial hash with buckets the size of the exclusion radius, so a
+        # pick only has to be checked against the 3x3 buckets around it.
+        # Bucket keys are flattened into single ints, which hash faster
+        stride = cols // distance + 3
+        neighbors = [
+            drow * stride + dcol for drow in (-1, 0, 1) for dcol in (-1, 0, 1)]
+        buckets = {}
+        for index in itertools.chain(avoid, chosen):
+            row, col = divmod(index, cols)
+            key = (row // distance + 1) * stride + col // distance + 1
+            buckets.setdefault(key, []).append((row, col))
+        limit = distance * distance
+
+        # Dart throwing; give up on this distance after too many misses in a
+        # row, since that means the floor is about full
+        misses = 0
+        max_misses = 30 + len(free) // 100
+        while len(chosen) < count and misses < max_misses:
+            index = free[rng.randrange(len(free))]
+            row, col = divmod(index, cols)
+            key = (row // distance + 1) * stride + col // distance + 1
+            crowded = False
+            for neighbor in neighbors:
+                for other_row, other_col in buckets.get(key + neighbor, ()):
+                    if (other_row - row) * (other_row - row) + (other_col - col) * (other_col - col) < limit:
+                        crowded = True
+                        break
+                if crowded:
+                    break
+            if crowded:
+                misses += 1
+                continue
+
+            misses = 0
+            chosen.append(index)
+            buckets.setdefault(key, []).append((row, col))
+
+        if len(chosen) >= count:
+            break
+        distance //= 2
+
+    if len(chosen) < count:
+        # No spacing left to keep, so just fill in whatever tiles are left
+        taken = set(chosen)
+        taken.update(avoid)
+        remaining = [index for index in free if index not in taken]
+        chosen.extend(rng.sample(remaining, min(count - len(chosen), len(remaining))))
+
+    return [Position(*divmod(index, cols)) for index in chosen]
+
+def populate(map, table, count, rng, min_distance=None, avoid=()):
+    """Puts `count` things, chosen from the `SpawnTable`, on free floor tiles
+    spread around the map.  Returns the things.
+    """
+    placed = []
+    for position in scatter(map, count, rng, min_distance=min_distance, avoid=avoid):
+        thing = things.Thing(type=table.choose(rng))
+        map.put(thing, position)
+        placed.append(thing)
+    return placed
+
+def populate_density(map, density, rng, thing_type=things.newt):
+    """Scatters creatures over roughly `density` of the free floor tiles,
+    spread out as evenly as they'll go.  Returns how many were placed.
+    """
+    count = int(len(free_tiles(map)) * density)
+    table = SpawnTable([(thing_type, 1)])
+    return len(populate(map, table, count, rng))
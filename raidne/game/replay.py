@@ -0,0 +1,212 @@
+"""Recording and replaying games.
+
+A dungeon is entirely determined by its seed, its fractor, and what the
+player does, so a replay log is just the seed, a description of the fractor,
+and a compact list of the player's actions.
+Actions are stored relative to the player -- "attack whatever's to the
+north", "pick up the second item here" -- which takes a byte or three apiece.
+"""
+import random
+import struct
+
+from raidne.game import action, population
+from raidne.game.things.bits import Meter
+from raidne.util import Offset
+
+# Opcodes
+WAIT = 0
+WALK = 1
+ATTACK = 2
+DESCEND = 3
+PICK_UP = 4
+USE_ITEM = 5
+
+# magic, version, seed, length of the JSON metadata that follows
+_header = struct.Struct('<4sBQI')
+_MAGIC = b'RDNR'
+
+class ReplayError(Exception):
+    pass
+
+class ReplayLog(object):
+    """The player's actions over the course of a game."""
+    version = 2
+
+    def __init__(self, seed, data=b'', metadata=None):
+        self.seed = seed
+        self._data = bytearray(data)
+        self.turns = 0
+
+        # Anything else needed to set the game up the same way again, as
+        # JSON-friendly values: the fractor's description (see
+        # `storage.describe_fractor`), plus what `set_up` goes by
+        self.metadata = {} if metadata is None else metadata
+
+    def actions_bytes(self, start=0):
+        """Returns just the recorded actions, without the header, from byte
+        `start` on.
+        """
+        return bytes(self._data[start:])
+
+    def extend(self, data):
+        """Appends actions previously returned by `actions_bytes`."""
+        self._data += data
+
+    def __len__(self):
+        return len(self._data)
+
+    def record(self, dungeon, command):
+        """Appends the player's `command`.  Has to be called before the
+        command is carried out, since it's encoded relative to the current
+        state of the game.
+        """
+        player = dungeon.player
+        floor = dungeon.current_floor
+        data = self._data
+
+        if isinstance(command, action.Wait):
+            data.append(WAIT)
+        elif isinstance(command, action.Walk):
+            # XXX assumes the direction is an offset
+            data.append(WALK)
+            data.extend(struct.pack('bb', *command.direction))
+        elif isinstance(command, action.MeleeAttack):
+            data.append(ATTACK)
+            data.extend(struct.pack('bb', *floor.distance_between(player, command.target)))
+        elif isinstance(command, action.Descend):
+            data.append(DESCEND)
+        elif isinstance(command, action.PickUp):
+            data.append(PICK_UP)
+            data.append(floor.find(player).items.index(command.target))
+        elif isinstance(command, action.UseItem):
+            data.append(USE_ITEM)
+            data.append(player.inventory.index(command.target))
+        else:
+            raise TypeError("Don't know how to record {0!r}".format(command))
+
+        self.turns += 1
+
+    def actions(self, dungeon):
+        """Generates the recorded actions one at a time.  Each has to be
+        carried out before asking for the next, since they're decoded relative
+        to the current state of `dungeon`.
+        """
+        data = self._data
+        i = 0
+        while i < len(data):
+            player = dungeon.player
+            floor = dungeon.current_floor
+            opcode = data[i]
+            i += 1
+
+            if opcode == WAIT:
+                yield action.Wait(player)
+            elif opcode == WALK:
+                yield action.Walk(player, Offset(*struct.unpack_from('bb', data, i)))
+                i += 2
+            elif opcode == ATTACK:
+                offset = Offset(*struct.unpack_from('bb', data, i))
+                i += 2
+                target = floor.tile(offset.relative_to(floor.position_of(player))).creature
+                if target is None:
+                    raise ReplayError("Nothing to attack at byte {0}".format(i - 3))
+                yield action.MeleeAttack(player, target)
+            elif opcode == DESCEND:
+                yield action.Descend(player, floor.find(player).architecture)
+            elif opcode == PICK_UP:
+                items = floor.find(player).items
+                if data[i] >= len(items):
+                    raise ReplayError("No item {0} to pick up at byte {1}".format(data[i], i - 1))
+                yield action.PickUp(player, items[data[i]])
+                i += 1
+            elif opcode == USE_ITEM:
+                if data[i] >= len(player.inventory):
+                    raise ReplayError("No item {0} to use at byte {1}".format(data[i], i - 1))
+                yield action.UseItem(player, player.inventory[data[i]])
+                i += 1
+            else:
+                raise ReplayError("Bad opcode {0} at byte {1}".format(opcode, i - 1))
+
+    def to_bytes(self):
+        import json
+        metadata = json.dumps(self.metadata, sort_keys=True).encode('utf8')
+        return (
+            _header.pack(_MAGIC, self.version, self.seed, len(metadata))
+            + metadata + bytes(self._data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        import json
+        magic, version, seed, length = _header.unpack_from(data)
+        if magic != _MAGIC:
+            raise ReplayError("Not a replay log")
+        if version != cls.version:
+            raise ReplayError("Can't read replay log version {0}".format(version))
+        offset = _header.size
+        metadata = json.loads(bytes(data[offset:offset + length]).decode('utf8'))
+        return cls(seed, data[offset + length:], metadata=metadata)
+
+    def fractor(self):
+        """Rebuilds the fractor the recorded game used, or returns `None` if
+        the log doesn't say.
+        """
+        description = self.metadata.get('fractor')
+        if description is None:
+            return None
+        from raidne.game.storage import rebuild_fractor
+        return rebuild_fractor(description)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def set_up(dungeon, rng=None):
+    """Finishes setting up a new game the way its replay log's metadata
+    says: scatters extra monsters over the first floor at `density`, and
+    makes the player unkillable if `immortal`.  Whatever first sets up a
+    game and whatever plays it back both have to go through here, or they'll
+    be playing different games.
+
+    Monsters are placed with `rng`, or a fresh one seeded from the dungeon.
+    """
+    metadata = dungeon.replay_log.metadata
+    if rng is None:
+        rng = random.Random(dungeon.seed)
+    density = metadata.get('density', 0)
+    if density:
+        population.populate_density(dungeon.current_floor, density, rng)
+    if metadata.get('immortal'):
+        dungeon.player.health = Meter(2**30)
+
+def start(log, dungeon_class=None, rng=None, **kwargs):
+    """Builds a dungeon set up just like the one `log` was recorded in.
+    Extra arguments go to `dungeon_class`.
+    """
+    if dungeon_class is None:
+        from raidne.game.dungeon import Dungeon as dungeon_class
+    dungeon = dungeon_class(
+        seed=log.seed, fractor=log.fractor(), prefetch=False, **kwargs)
+    # So recording the replay makes the same log again
+    dungeon.replay_log.metadata.update(log.metadata)
+    set_up(dungeon, rng)
+    return dungeon
+
+def replay(log, dungeon_class=None, turns=None):
+    """Plays back a replay log, as fast as possible, and returns the
+    resulting dungeon.  Stops early after `turns` turns, if given.
+    """
+    dungeon = start(log, dungeon_class)
+
+    for played, command in enumerate(log.actions(dungeon)):
+        if turns is not None and played >= turns:
+            break
+        dungeon.player_command(command)
+        dungeon.do_monster_turns()
+
+    return dungeon
@@ -0,0 +1,89 @@
+"""Turn order.  Every creature on a floor has a time at which it's next ready
+to act; acting pushes that time back by the cost of whatever it did.
+"""
+import heapq
+import itertools
+
+class Schedule(object):
+    """Priority queue of actors, keyed on the time each one is next ready.
+
+    Removal is lazy: discarded entries are just blanked out and skipped when
+    they reach the front of the heap.  Ties are broken by insertion order, so
+    things scheduled at the same time act first-come first-served.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+        # Actors whose ready time has been set since this was last cleared.
+        # Whoever cares (e.g. autosaving) is responsible for clearing it.
+        self.changed = set()
+
+        # Optional `CreatureStore` to keep ready times in
+        self.store = None
+
+    def __contains__(self, actor):
+        return actor in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, actor, time):
+        entry = [time, next(self._counter), actor]
+        self._entries[actor] = entry
+        heapq.heappush(self._heap, entry)
+        self.changed.add(actor)
+        if self.store is not None:
+            self.store.set_ready(actor, time)
+
+    def add(self, actor, delay=0):
+        """Start tracking `actor`, who will be ready `delay` ticks from now."""
+        assert actor not in self._entries
+        self._push(actor, self.now + delay)
+
+    def discard(self, actor):
+        """Stop tracking `actor`, if it's tracked at all."""
+        entry = self._entries.pop(actor, None)
+        if entry is not None:
+            entry[-1] = None
+        self.changed.discard(actor)
+
+    def queue(self):
+        """Returns (ready time, actor) for everyone, in the order they'll act.
+        """
+        return [
+            (entry[0], entry[-1])
+            for entry in sorted(self._entries.values())]
+
+    def ready_time(self, actor):
+        return self._entries[actor][0]
+
+    def turn_order_key(self, actor):
+        """Returns a key that sorts actors in the order they'll act."""
+        return tuple(self._entries[actor][:2])
+
+    def next_actor(self):
+        """Returns whoever's up next, advancing the clock to their ready time,
+        or `None` if nobody's left.  The actor stays in the queue; call
+        `spend` once they've done something.
+        """
+        heap = self._heap
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+
+        time, _, actor = heap[0]
+        if time > self.now:
+            self.now = time
+        return actor
+
+    def spend(self, actor, cost):
+        """Charge `actor` for an action, pushing back when they're next ready.
+        """
+        entry = self._entries.pop(actor)
+        entry[-1] = None
+        self._push(actor, entry[0] + cost)
@@ -0,0 +1,827 @@
+"""Writing floors and whole games to disk and reading them back.
+
+A floor is stored as a small header, the map's RNG state, the architecture
+type-code array (optionally zlib-compressed), a bitmask of the tiles the
+player remembers seeing, and then a record for every item and creature.  Chunked floors store how to generate the architecture instead,
+plus any chunks that have changed since.  Things are stored by `ThingType.type_id`, plus whatever
+per-instance state they have: health and inventory.  Caches like distance maps
+aren't stored; they're rebuilt on demand.  Just a few tiles of a floor can be
+stored too, to patch into an older copy of it; see `raidne.game.journal`.
+
+A saved game is a sequence of chunks, each a four-byte tag, a length, and a
+payload: some metadata, the replay log and message queue, things in transit
+between floors, and then one chunk per floor.  Chunks are written one at a
+time, and on loading the file is memory-mapped and floors are only decoded
+when they're first visited.
+"""
+from collections import OrderedDict
+import importlib
+import mmap
+import os
+import os.path
+import struct
+import zlib
+
+from raidne.game import things
+from raidne.game.chunks import ChunkedArchitectureLayer
+from raidne.game.map import ArchitectureLayer, Map
+from raidne.util import Position, Size
+
+_MAGIC = b'RDNF'
+VERSION = 5
+
+# magic, version, rows, cols, depth, entrance row and col (-1 for none),
+# schedule clock
+_floor_header = struct.Struct('<4sBIIiiiQ')
+# Mersenne Twister state: version, 625 words, whether there's a cached gauss
+_rng_state = struct.Struct('<B625IBd')
+_count = struct.Struct('<I')
+# flags, length
+_architecture_header = struct.Struct('<BI')
+_COMPRESSED = 0x01
+_CHUNKED = 0x02
+# chunk row, chunk col
+_chunk_key = struct.Struct('<ii')
+# Remembered tiles are kept as one bitmask per block of this many tiles
+# square, and only blocks with something remembered in them are written --
+# chunked floors are far too big for one bitmask of the whole thing
+_MEMORY_BLOCK = 64
+_memory_mask_bytes = _MEMORY_BLOCK * _MEMORY_BLOCK // 8
+_item_header = struct.Struct('<II')
+# row, col, ready time relative to the clock, flags
+_creature_header = struct.Struct('<IIQB')
+_IS_PLAYER = 0x01
+# type id, health (-1 for none), inventory size
+_thing_header = struct.Struct('<HiH')
+
+class StorageError(Exception):
+    pass
+
+
+### Things
+
+def dump_thing(thing, out):
+    """Appends a record for `thing` (and its inventory) to the bytearray
+    `out`.
+    """
+    health = getattr(thing, 'health', None)
+    # Don't go creating empty inventories just to write them out
+    inventory = thing._inventory or ()
+    out += _thing_header.pack(
+        thing.type.type_id,
+        -1 if health is None else health.current,
+        len(inventory))
+    for item in inventory:
+        dump_thing(item, out)
+
+def load_thing(data, offset):
+    """Reads a thing record from `data` at `offset`.  Returns the thing and
+    the offset just past it.
+    """
+    type_id, health, inventory_size = _thing_header.unpack_from(data, offset)
+    offset += _thing_header.size
+
+    thing = things.Thing(type=things.ThingType.registry[type_id])
+    if health >= 0:
+        thing.health.current = health
+    for _ in range(inventory_size):
+        item, offset = load_thing(data, offset)
+        thing.inventory.append(item)
+    return thing, offset
+
+
+### Fractors
+
+def describe_fractor(fractor):
+    """Returns enough JSON-friendly information to rebuild `fractor`."""
+    return dict(
+        cls=type(fractor).__module__ + ':' + type(fractor).__qualname__,
+        params=vars(fractor),
+    )
+
+def rebuild_fractor(description):
+    module_name, _, class_name = description['cls'].partition(':')
+    fractor_class = getattr(importlib.import_module(module_name), class_name)
+    fractor = fractor_class.__new__(fractor_class)
+    fractor.__dict__.update(description['params'])
+    return fractor
+
+
+### Floors
+
+def _dump_rng(rng, out):
+    version, words, gauss = rng.getstate()
+    out += _rng_state.pack(
+        version, *words, gauss is not None, gauss or 0.0)
+
+def _load_rng(rng, data, offset):
+    fields = _rng_state.unpack_from(data, offset)
+    rng.setstate((fields[0], fields[1:626], fields[627] if fields[626] else None))
+
+def dump_floor(map, player=None, compress=False):
+    """Serializes a floor to bytes.  If `player` is on the floor, it's marked
+    as such, so it can be picked out again when loading.
+    """
+    out = bytearray()
+    depth = -1 if map.depth is None else map.depth
+    entrance = (-1, -1) if map.entrance is None else map.entrance
+    now = map.schedule.now
+    out += _floor_header.pack(
+        _MAGIC, VERSION, map.size.rows, map.size.cols, depth, *entrance, now)
+
+    _dump_rng(map.rng, out)
+
+    flags = 0
+    layer = map._architecture
+    if isinstance(layer, ChunkedArchitectureLayer):
+        # Only the recipe for generating the floor, plus whatever's been
+        # changed since
+        flags |= _CHUNKED
+        import json
+        spec = json.dumps(dict(
+            fractor=describe_fractor(layer.fractor),
+            seed=layer.seed,
+            chunk_size=layer.chunk_size,
+        )).encode('utf8')
+        architecture = bytearray(_count.pack(len(spec)) + spec)
+        chunks = list(layer.modified_chunks())
+        architecture += _count.pack(len(chunks))
+        for key, chunk in chunks:
+            architecture += _chunk_key.pack(*key)
+            architecture += chunk
+    else:
+        architecture = layer.to_bytes()
+    if compress:
+        flags |= _COMPRESSED
+        architecture = zlib.compress(architecture)
+    out += _architecture_header.pack(flags, len(architecture))
+    out += architecture
+    _dump_memory(map, out)
+
+    # Sorted, so the same floor always comes out the same no matter what
+    # order things were dropped in; the sort is stable, so stacks keep theirs
+    items = sorted(map.iter_items(), key=lambda pair: pair[0])
+    out += _count.pack(len(items))
+    for position, item in items:
+        out += _item_header.pack(position.row, position.col)
+        dump_thing(item, out)
+
+    # Creatures go in turn order, so ties come back out the same way
+    queue = map.schedule.queue()
+    out += _count.pack(len(queue))
+    for ready, creature in queue:
+        position = map.position_of(creature)
+        flags = _IS_PLAYER if creature is player else 0
+        out += _creature_header.pack(position.row, position.col, ready - now, flags)
+        dump_thing(creature, out)
+
+    return bytes(out)
+
+def _dump_memory(map, out, remembered=None):
+    """Writes the remembered positions in `remembered`, or by default
+    everything remembered on the floor.
+    """
+    if remembered is None:
+        remembered = map.remembered()
+    size = _MEMORY_BLOCK
+    blocks = {}
+    for row, col in remembered:
+        block_row, row = divmod(row, size)
+        block_col, col = divmod(col, size)
+        mask = blocks.get((block_row, block_col))
+        if mask is None:
+            mask = blocks[block_row, block_col] = bytearray(_memory_mask_bytes)
+        index = row * size + col
+        mask[index >> 3] |= 1 << (index & 7)
+
+    memory = bytearray(_count.pack(len(blocks)))
+    for key in sorted(blocks):
+        memory += _chunk_key.pack(*key)
+        memory += blocks[key]
+    memory = zlib.compress(memory)
+    out += _count.pack(len(memory))
+    out += memory
+
+def _load_memory(data, offset):
+    """Returns the remembered positions written by `_dump_memory`, and the
+    offset just past them.
+    """
+    length, = _count.unpack_from(data, offset)
+    offset += _count.size
+    memory = zlib.decompress(data[offset:offset + length])
+    offset += length
+
+    size = _MEMORY_BLOCK
+    remembered = set()
+    count, = _count.unpack_from(memory)
+    position = _count.size
+    for _ in range(count):
+        block_row, block_col = _chunk_key.unpack_from(memory, position)
+        position += _chunk_key.size
+        mask = memory[position:position + _memory_mask_bytes]
+        position += _memory_mask_bytes
+        top = block_row * size
+        left = block_col * size
+        for byte_index, byte in enumerate(mask):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte >> bit & 1:
+                    row, col = divmod(byte_index * 8 + bit, size)
+                    remembered.add((top + row, left + col))
+    return remembered, offset
+
+def _load_chunked(size, data):
+    length, = _count.unpack_from(data)
+    import json
+    spec = json.loads(bytes(data[_count.size:_count.size + length]).decode('utf8'))
+    offset = _count.size + length
+
+    layer = ChunkedArchitectureLayer(
+        size, rebuild_fractor(spec['fractor']), spec['seed'], chunk_size=spec['chunk_size'])
+    chunk_bytes = layer.chunk_size ** 2
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        key = _chunk_key.unpack_from(data, offset)
+        offset += _chunk_key.size
+        chunk = data[offset:offset + chunk_bytes]
+        if len(chunk) != chunk_bytes:
+            raise StorageError("Floor is truncated")
+        layer.restore_chunk(key, chunk)
+        offset += chunk_bytes
+    return layer
+
+def floor_depth(data):
+    """Reads just the depth out of a serialized floor."""
+    return _floor_header.unpack_from(data)[4]
+
+def load_floor(data):
+    """Rebuilds a floor from the output of `dump_floor`.  `data` can be
+    anything supporting the buffer protocol.
+
+    Returns the floor, and the thing marked as the player (or `None`).
+    Raises `StorageError` if `data` isn't a whole, readable floor.
+    """
+    try:
+        return _load_floor(data)
+    except (struct.error, zlib.error, ValueError, IndexError, KeyError,
+            AttributeError, ImportError):
+        # Cut short or scribbled on somewhere past the header: a record
+        # runs off the end, a type id or fractor name is garbage, health
+        # turns up on a thing that can't have any...
+        raise StorageError("Floor is truncated or corrupt") from None
+
+def _load_floor(data):
+    data = memoryview(data)
+    (magic, version, rows, cols, depth, entrance_row, entrance_col, now
+        ) = _floor_header.unpack_from(data)
+    if magic != _MAGIC:
+        raise StorageError("Not a floor")
+    if version != VERSION:
+        raise StorageError("Can't read floor version {0}".format(version))
+    offset = _floor_header.size
+
+    rng_offset = offset
+    offset += _rng_state.size
+
+    flags, length = _architecture_header.unpack_from(data, offset)
+    offset += _architecture_header.size
+    architecture = data[offset:offset + length]
+    offset += length
+    if len(architecture) != length:
+        raise StorageError("Floor is truncated")
+    if flags & _COMPRESSED:
+        architecture = zlib.decompress(architecture)
+    size = Size(rows=rows, cols=cols)
+    if flags & _CHUNKED:
+        architecture = _load_chunked(size, architecture)
+    elif len(architecture) != rows * cols:
+        raise StorageError("Floor's architecture is the wrong size")
+    else:
+        architecture = ArchitectureLayer.from_bytes(size, architecture)
+    remembered, offset = _load_memory(data, offset)
+
+    map = Map.from_architecture(architecture)
+    map.depth = None if depth < 0 else depth
+    if entrance_row >= 0:
+        map.entrance = Position(entrance_row, entrance_col)
+    _load_rng(map.rng, data, rng_offset)
+    map.schedule.now = now
+
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        row, col = _item_header.unpack_from(data, offset)
+        offset += _item_header.size
+        item, offset = load_thing(data, offset)
+        map.put(item, _loaded_position(map, row, col))
+
+    player = None
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        row, col, delay, flags = _creature_header.unpack_from(data, offset)
+        offset += _creature_header.size
+        creature, offset = load_thing(data, offset)
+        position = _loaded_position(map, row, col)
+        if map.tile(position).creature is not None:
+            raise StorageError("Two creatures at {0}".format(position))
+        map.put(creature, position)
+        map.schedule.discard(creature)
+        map.schedule.add(creature, delay)
+        if flags & _IS_PLAYER:
+            player = creature
+
+    map.remember(remembered, player)
+    return map, player
+
+def _loaded_position(map, row, col):
+    position = Position(row, col)
+    if position not in map.size:
+        raise StorageError("Thing off the edge of the floor at {0}".format(position))
+    return position
+
+
+### Partial floors
+
+# schedule clock
+_clock = struct.Struct('<Q')
+# whether the RNG table is unchanged, and if so the position in it and the
+# cached gauss
+_rng_position = struct.Struct('<BIBd')
+# row, col, architecture type code, item count, whether there's a creature
+_tile_header = struct.Struct('<IIBIB')
+# row, col, ready time relative to the clock
+_turn_header = struct.Struct('<IIQ')
+
+def dump_tiles(map, positions, player=None, rescheduled=(), rng_words=None,
+        remembered=()):
+    """Serializes just the given positions of a floor -- everything on them,
+    plus the floor's clock and RNG state -- so they can be patched into an
+    older copy of the floor with `load_tiles`.  Positions newly remembered
+    since that copy go in `remembered`; see `MapChanges.remembered`.
+
+    The RNG's state is mostly a big table that only changes every few hundred
+    draws; if it's still `rng_words`, what the older copy had, only the
+    position in the table is written.
+
+    Creatures are put back at the end of the turn order, which is only right
+    if they've all been rescheduled since the older copy was made; so if any
+    of them isn't in `rescheduled`, the whole turn order is written as well.
+    """
+    out = bytearray()
+    now = map.schedule.now
+    out += _clock.pack(now)
+    version, words, gauss = map.rng.getstate()
+    if words[:-1] == (rng_words or ())[:-1]:
+        out += _rng_position.pack(True, words[-1], gauss is not None, gauss or 0.0)
+    else:
+        out += _rng_position.pack(False, 0, 0, 0.0)
+        _dump_rng(map.rng, out)
+
+    architecture = map._architecture
+    items = map._items
+    critters = map._critters
+    schedule = map.schedule
+
+    # Creatures are put back in the order they come out, so they have to go
+    # in turn order
+    positions = sorted(positions, key=lambda position: (
+        position in critters,
+        schedule.turn_order_key(critters[position]) if position in critters else ()))
+
+    creatures = []
+    out += _count.pack(len(positions))
+    for position in positions:
+        tile_items = items.get(position, ())
+        creature = critters.get(position)
+        out += _tile_header.pack(
+            position.row, position.col, architecture.type_at(position).type_code,
+            len(tile_items), creature is not None)
+        for item in tile_items:
+            dump_thing(item, out)
+        if creature is not None:
+            creatures.append(creature)
+            flags = _IS_PLAYER if creature is player else 0
+            out += _creature_header.pack(
+                position.row, position.col,
+                schedule.ready_time(creature) - now, flags)
+            dump_thing(creature, out)
+
+    if all(creature in rescheduled for creature in creatures):
+        out += _count.pack(0)
+    else:
+        queue = schedule.queue()
+        out += _count.pack(len(queue))
+        for ready, creature in queue:
+            position = map.position_of(creature)
+            out += _turn_header.pack(position.row, position.col, ready - now)
+
+    # Memory only ever grows, so what's new is all the older copy lacks
+    _dump_memory(map, out, remembered)
+    return bytes(out)
+
+def load_tiles(map, data, offset=0):
+    """Patches the output of `dump_tiles` into `map`.  Returns the creature
+    marked as the player, if any, and the offset just past the data.
+    """
+    now, = _clock.unpack_from(data, offset)
+    offset += _clock.size
+    same_table, position, has_gauss, gauss = _rng_position.unpack_from(data, offset)
+    offset += _rng_position.size
+    if same_table:
+        version, words, _ = map.rng.getstate()
+        map.rng.setstate((version, words[:-1] + (position,), gauss if has_gauss else None))
+    else:
+        _load_rng(map.rng, data, offset)
+        offset += _rng_state.size
+    map.schedule.now = now
+
+    # Read everything first, since a creature may have moved between two of
+    # the tiles
+    tiles = []
+    player = None
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        row, col, code, item_count, has_creature = _tile_header.unpack_from(data, offset)
+        offset += _tile_header.size
+        tile_items = []
+        for _ in range(item_count):
+            item, offset = load_thing(data, offset)
+            tile_items.append(item)
+        creature = None
+        if has_creature:
+            _, _, delay, flags = _creature_header.unpack_from(data, offset)
+            offset += _creature_header.size
+            creature, offset = load_thing(data, offset)
+            creature = creature, delay
+            if flags & _IS_PLAYER:
+                player = creature[0]
+        tiles.append((Position(row, col), code, tile_items, creature))
+
+    for position, _, _, _ in tiles:
+        tile = map.tile(position)
+        for thing in list(tile.items):
+            map.remove(thing)
+        if tile.creature is not None:
+            map.remove(tile.creature)
+
+    for position, code, tile_items, creature in tiles:
+        map.set_architecture(position, things.Architecture.by_code[code])
+        for item in tile_items:
+            map.put(item, position)
+        if creature is not None:
+            creature, delay = creature
+            map.put(creature, position)
+            map.schedule.discard(creature)
+            map.schedule.add(creature, delay)
+
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        row, col, delay = _turn_header.unpack_from(data, offset)
+        offset += _turn_header.size
+        creature = map.tile(Position(row, col)).creature
+        map.schedule.discard(creature)
+        map.schedule.add(creature, delay)
+
+    remembered, offset = _load_memory(data, offset)
+    map.remember(remembered, player)
+    return player, offset
+
+
+class FloorStore(object):
+    """All the floors of a dungeon, by depth, of which only the most recently
+    used few are kept in memory.  The rest are written out to a scratch
+    directory and read back when asked for.  Floors that have never existed
+    are generated on the spot.
+
+    `generate` is a function taking a depth and returning a new floor;
+    `on_load`, if given, is called with every floor that becomes resident,
+    whether freshly generated or read back from disk.
+
+    Floors can also be generated ahead of time with `prefetch`, which does the
+    work on a background thread.
+    """
+    resident_limit = 2
+
+    def __init__(self, generate, on_load=None, directory=None, resident_limit=None):
+        self._generate = generate
+        self._on_load = on_load
+        if resident_limit is not None:
+            self.resident_limit = resident_limit
+        assert self.resident_limit >= 1
+
+        # If no directory is given, a temporary one is made the first time
+        # anything needs to be written
+        self._owns_directory = directory is None
+        self.directory = directory
+
+        # depth => map, least recently used first
+        self._resident = OrderedDict()
+        self._on_disk = set()
+
+        # depth => future, for floors being generated in the background
+        self._pending = {}
+        self._executor = None
+
+        # depth => buffer, for floors in a saved game that haven't been
+        # decoded yet; plus whatever needs closing when we're done with them
+        self._sources = {}
+        self._mappings = []
+
+    def __contains__(self, depth):
+        """Whether the floor at `depth` exists yet, in memory or on disk."""
+        return (
+            depth in self._resident or
+            depth in self._on_disk or
+            depth in self._sources)
+
+    def depths(self):
+        """Returns the depths of every floor that exists, in order."""
+        return sorted(set(self._resident) | self._on_disk | set(self._sources))
+
+    def add_source(self, depth, data):
+        """Registers a serialized floor, to be decoded the first time it's
+        asked for.  Replaces any existing version of the floor.
+        """
+        self._resident.pop(depth, None)
+        self._on_disk.discard(depth)
+        old = self._sources.get(depth)
+        if old is not None:
+            old.release()
+        self._sources[depth] = data
+
+    def replace(self, map):
+        """Swaps in a new version of a floor, throwing away the old one
+        wherever it was.
+        """
+        depth = map.depth
+        self._resident.pop(depth, None)
+        self._on_disk.discard(depth)
+        data = self._sources.pop(depth, None)
+        if data is not None:
+            data.release()
+        self.add_resident(map)
+
+    def floor_bytes(self, depth, player=None, compress=False):
+        """Returns the floor at `depth`, serialized, without bringing it into
+        memory.  If it's already serialized somewhere, that's returned as-is.
+        """
+        if depth in self._resident:
+            return dump_floor(self._resident[depth], player=player, compress=compress)
+        elif depth in self._sources:
+            return bytes(self._sources[depth])
+        else:
+            with open(self._path(depth), 'rb') as f:
+                return f.read()
+
+    def is_resident(self, depth):
+        return depth in self._resident
+
+    def resident(self):
+        """Returns the floors currently in memory."""
+        return list(self._resident.values())
+
+    def __getitem__(self, depth):
+        map = self._resident.get(depth)
+        if map is not None:
+            self._resident.move_to_end(depth)
+            self._evict()
+            return map
+
+        if depth in self._sources:
+            data = self._sources.pop(depth)
+            map, _ = load_floor(data)
+            data.release()
+        elif depth in self._on_disk:
+            with open(self._path(depth), 'rb') as f:
+                map, _ = load_floor(f.read())
+        elif depth in self._pending:
+            # Blocks if it's not quite done yet
+            map = self._pending.pop(depth).result()
+        else:
+            map = self._generate_floor(depth)
+
+        self._resident[depth] = map
+        if self._on_load:
+            self._on_load(map)
+        self._evict()
+        return map
+
+    def add_resident(self, map):
+        """Adds an already-built floor."""
+        assert map.depth not in self
+        self._resident[map.depth] = map
+        if self._on_load:
+            self._on_load(map)
+        self._evict()
+
+    def _generate_floor(self, depth):
+        map = self._generate(depth)
+        map.depth = depth
+        return map
+
+    def prefetch(self, depth):
+        """Starts generating the floor at `depth` in the background, unless
+        it already exists.
+        """
+        if depth in self or depth in self._pending:
+            return
+
+        if self._executor is None:
+            # Imported here, since it's slow to import and the game should
+            # be on screen before anything needs generating
+            from concurrent.futures import ThreadPoolExecutor
+            # Generation is mostly pure Python, so more than one worker
+            # wouldn't buy much
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='raidne-fractor')
+        self._pending[depth] = self._executor.submit(self._generate_floor, depth)
+
+    def _path(self, depth):
+        if self.directory is None:
+            import tempfile
+            self.directory = tempfile.mkdtemp(prefix='raidne-floors-')
+        return os.path.join(self.directory, 'floor-{0}.bin'.format(depth))
+
+    def _evict(self):
+        while len(self._resident) > self.resident_limit:
+            depth, map = self._resident.popitem(last=False)
+            with open(self._path(depth), 'wb') as f:
+                f.write(dump_floor(map))
+            self._on_disk.add(depth)
+
+    def close(self):
+        """Stops any background work, and throws away everything on disk if
+        this store created the directory itself.
+        """
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending.clear()
+
+        for data in self._sources.values():
+            data.release()
+        self._sources.clear()
+        for mapping in self._mappings:
+            mapping.close()
+        del self._mappings[:]
+
+        if self._owns_directory and self.directory is not None:
+            import shutil
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self._on_disk.clear()
+
+
+### Saved games
+
+_SAVE_MAGIC = b'RDNS'
+SAVE_VERSION = 1
+
+_save_header = struct.Struct('<4sB')
+_chunk_header = struct.Struct('<4sQ')
+# depth, whether there's a position, row, col
+_moving_header = struct.Struct('<iBII')
+
+def _write_chunk(f, tag, payload):
+    f.write(_chunk_header.pack(tag, len(payload)))
+    f.write(payload)
+
+def dump_moving_things(moving_things):
+    """Serializes a dungeon's `moving_things`."""
+    out = bytearray()
+    entries = [
+        (depth, thing, position)
+        for depth, waiting in sorted(moving_things.items())
+        for thing, position in waiting]
+    out += _count.pack(len(entries))
+    for depth, thing, position in entries:
+        out += _moving_header.pack(
+            depth, position is not None, *(position or (0, 0)))
+        dump_thing(thing, out)
+    return bytes(out)
+
+def load_moving_things(data, offset=0):
+    """Reads the output of `dump_moving_things`.  Returns a list of (depth,
+    thing, position) and the offset just past the data.
+    """
+    entries = []
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    for _ in range(count):
+        depth, has_position, row, col = _moving_header.unpack_from(data, offset)
+        offset += _moving_header.size
+        thing, offset = load_thing(data, offset)
+        entries.append((depth, thing, Position(row, col) if has_position else None))
+    return entries, offset
+
+def save_dungeon(dungeon, path, **extra):
+    """Writes the whole game to `path`.  The file is written alongside and
+    then moved into place, so a crash partway through doesn't clobber an
+    older save -- and so it's safe to save over a file the dungeon was loaded
+    from.
+    """
+    import json
+    meta = dict(
+        seed=dungeon.seed,
+        depth=dungeon.current_floor.depth,
+        fractor=describe_fractor(dungeon.fractor),
+        **extra
+    )
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(_save_header.pack(_SAVE_MAGIC, SAVE_VERSION))
+        _write_chunk(f, b'META', json.dumps(meta).encode('utf8'))
+        _write_chunk(f, b'RPLY', dungeon.replay_log.to_bytes())
+        _write_chunk(f, b'MSGS', json.dumps(dungeon.pending_messages()).encode('utf8'))
+
+        _write_chunk(f, b'MOVE', dump_moving_things(dungeon.moving_things))
+
+        # One floor at a time, so only one is ever serialized in memory
+        for depth in dungeon.floors.depths():
+            _write_chunk(f, b'FLOR', dungeon.floors.floor_bytes(
+                depth, player=dungeon.player, compress=True))
+
+        _write_chunk(f, b'END ', b'')
+
+    os.replace(temp_path, path)
+
+def load_dungeon(cls, path, prefetch=True):
+    """Reads a game written by `save_dungeon`, returning an instance of the
+    Dungeon subclass `cls`.  Only the current floor is decoded right away; the
+    rest stay in the memory-mapped file until they're visited.  `prefetch` is
+    as for `Dungeon`.
+    """
+    import json
+    from raidne.game.replay import ReplayLog
+
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = memoryview(mapping)
+
+    magic, version = _save_header.unpack_from(data)
+    if magic != _SAVE_MAGIC:
+        raise StorageError("Not a saved game")
+    if version != SAVE_VERSION:
+        raise StorageError("Can't read saved game version {0}".format(version))
+
+    chunks = []
+    offset = _save_header.size
+    while True:
+        tag, length = _chunk_header.unpack_from(data, offset)
+        offset += _chunk_header.size
+        if tag == b'END ':
+            break
+        chunks.append((tag, data[offset:offset + length]))
+        offset += length
+
+    meta = None
+    floors = {}
+    for tag, payload in chunks:
+        if tag == b'META':
+            meta = json.loads(bytes(payload).decode('utf8'))
+        elif tag == b'FLOR':
+            floors[floor_depth(payload)] = payload
+    if meta is None:
+        raise StorageError("Saved game has no metadata")
+
+    dungeon = cls.__new__(cls)
+    dungeon._setup(seed=meta['seed'], fractor=rebuild_fractor(meta['fractor']))
+
+    for tag, payload in chunks:
+        if tag == b'RPLY':
+            dungeon.replay_log = ReplayLog.from_bytes(bytes(payload))
+        elif tag == b'MSGS':
+            dungeon.restore_messages(json.loads(bytes(payload).decode('utf8')))
+        elif tag == b'MOVE':
+            moving, _ = load_moving_things(payload)
+            for depth, thing, position in moving:
+                dungeon.moving_things[depth].append((thing, position))
+
+    dungeon.save_metadata = meta
+
+    depth = meta['depth']
+    current, player = load_floor(floors.pop(depth))
+    if player is None:
+        raise StorageError("Saved game has no player")
+    dungeon.player = player
+
+    for other_depth, payload in floors.items():
+        dungeon.floors.add_source(other_depth, payload)
+    for tag, payload in chunks:
+        if tag != b'FLOR':
+            payload.release()
+    data.release()
+    dungeon.floors._mappings.append(mapping)
+
+    dungeon.floors.add_resident(current)
+    dungeon.prefetch = prefetch
+    dungeon.enter_floor(depth)
+    return dungeon
@@ -4,19 +4,32 @@
 Various Things are organized into submodules, but you should import them from
 this module directly; it contains everything.
 """
-import random
+import importlib
 
-from raidne.game import action, effect
+from raidne.game import action
+from raidne.game.pathing import DIRECTIONS
 from raidne.game.things.bits import Meter
+from raidne.util import Position
+
+# Category bits, for telling kinds of things apart with an integer test; see
+# `ThingType.categories`
+ARCHITECTURE = 1
+CREATURE = 2
+ITEM = 4
+SOLID = 8
 
 class Thing(object):
     """Represents a discrete object that can appear within the dungeon.
     Includes walls, floors, the player, traps, items, etc.
     """
 
-    is_player = False
-
+    # There can be a lot of these, so no __dict__, and anything a thing might
+    # not need is only created when it's first asked for
+    __slots__ = (
+        '_type', '_hooks', '_inventory', '_health', '_component_data',
+        '_components', '_store')
 
+    is_player = False
 
     def __init__(self, type, **kwargs):
         """Create an object.
@@ -29,43 +42,109 @@ class Thing(object):
 
         self._type = type
 
-        self._hooks = []
+        self._hooks = None
+        self._inventory = None
+        self._health = None
+        self._component_data = None
+        # Adapted components, by interface
+        self._components = None
+        # The `CreatureStore` holding this thing's stats, if any
+        self._store = None
+
+    @property
+    def inventory(self):
+        if self._inventory is None:
+            self._inventory = []
+        return self._inventory
 
-        self.inventory = []
-        if type.max_health:
-            self.health = Meter(type.max_health)
+    @property
+    def health(self):
+        # Only things with a maximum health have any health at all
+        if self._health is None:
+            if not self._type.max_health:
+                raise AttributeError("{0!r} has no health".format(self._type.name))
+            self._health = Meter(self._type.max_health)
+        return self._health
+
+    @health.setter
+    def health(self, value):
+        if self._store is not None:
+            self._store.replace_meter(self, value)
+            return
+        # Whoever was watching the old health keeps watching, as with a
+        # CreatureStore -- usually the map, so the change gets drawn and saved
+        old = self._health
+        if old is not None and value.watcher is None:
+            value.watcher = old.watcher
+        self._health = value
 
-        self._component_data = {}
+    @property
+    def component_data(self):
+        if self._component_data is None:
+            self._component_data = {}
+        return self._component_data
 
     def __conform__(self, iface):
         # z.i method called on an object to ask it to adapt itself to some
-        # interface
+        # interface.  Components are made once and kept, either here or, if
+        # they don't care which thing they belong to, on the type
+        components = self._components
+        if components is not None:
+            component = components.get(iface)
+            if component is not None:
+                return component
+
         # TODO keyerror
-        component = self._type.components[iface]
-        return component(iface, self)
+        component_class = self._type.components[iface]
+        if component_class.stateless:
+            return self._type.shared_component(iface)
+
+        component = component_class(iface, self)
+        if components is None:
+            components = self._components = {}
+        components[iface] = component
+        return component
 
 
     def isa(self, thing_type):
+        """Whether this is a particular ThingType, or a kind of ThingType.
+        Also takes a mask of category bits, all of which have to be set.
+        """
+        if thing_type.__class__ is int:
+            return self._type.categories & thing_type == thing_type
+        # The broad kinds of ThingType can be answered from the category bits
+        mask = _category_classes.get(thing_type)
+        if mask is not None:
+            return self._type.categories & mask != 0
         if isinstance(thing_type, type):
             return isinstance(self._type, thing_type)
-        else:
-            return self._type is thing_type
+        return self._type is thing_type
 
 
     ### Properties
     # XXX only some thingtypes have certain properties.  components ahoy?
     # XXX this is where i can do hooks, caching, etc
 
+    @property
+    def type(self):
+        return self._type
+
     @property
     def solid(self):
         return self._type.solid
 
+    @property
+    def categories(self):
+        return self._type.categories
+
     @property
     def name(self):
         return self._type.name
 
     @property
     def attack_power(self):
+        if self._store is not None:
+            return self._store.attack_power[self._store.slot_of(self)]
         return self._type.attack_power
 
     ### Other ThingType proxies
@@ -80,8 +159,7 @@ class Thing(object):
         # and so on.  you know, FSM stuff.
 
         # For now, there are no states.  Our AI is HTTP.
-        here = map.find(self)
-        adjacent_tiles = list(here.adjacent_tiles())
+        here = map.position_of(self)
 
         # And our only target is the player.
         player = dungeon.player
@@ -99,17 +177,25 @@ class Thing(object):
             return action.MeleeAttack(self, player)
 
         # 2. Is the player visible?  If so, run straight at him like a lunatic.
-        # TODO the map is currently just a big room and all, so the player is
-        # always visible...
-        pass
+        # Sight is symmetric, so ask the player's field of view instead of
+        # computing one per monster.  Everyone chasing the player shares the
+        # same distance map, so this is just a matter of rolling downhill.
+        if map.field_of_view(player).can_see(here):
+            for step in map.distance_map(player).downhill(here):
+                if map.is_open(step):
+                    return action.Walk(self, step)
 
         # 3. Otherwise, just mill around or something.
         # TODO solid doesn't really cut it here.  also want to
         # avoid traps and veer towards items, for example.
         # TODO but some traps are good!!  this is insane
-        possible_tiles = [tile for tile in adjacent_tiles if not any(thing.solid for thing in tile)]
-        if possible_tiles:
-            return action.Walk(self, random.choice(possible_tiles).position)
+        possible_steps = [
+            position for position in (
+                Position(here.row + drow, here.col + dcol)
+                for drow, dcol in DIRECTIONS)
+            if map.is_open(position)]
+        if possible_steps:
+            return action.Walk(self, map.rng.choice(possible_steps))
 
         return None
 
@@ -120,7 +206,18 @@ class ThingType:
     max_health = 0
     name = "it"
 
+    # Category bit for every type of this class
+    category = 0
+
+    # Every ThingType gets a small integer id, in order of creation, so things
+    # can be written to disk compactly and found again when read back
+    registry = []
+
     def __init__(self, *components, solid=False, max_health=None, name=None):
+        self.type_id = len(ThingType.registry)
+        assert self.type_id < 65536
+        ThingType.registry.append(self)
+
         if solid:
             self.solid = solid
         if max_health:
@@ -128,31 +225,95 @@ class ThingType:
         if name:
             self.name = name
 
-        self.components = {}
-        for component in components:
+        self.categories = type(self).category | (SOLID if self.solid else 0)
+
+        # Components can be given as "module:Class" names, so they don't have
+        # to be imported until they're used; see `components`
+        self._component_sources = components
+        self._components = None
+        # Interface => {attribute name => function(entity) returning its value}
+        self._component_accessors = None
+        self._shared_components = {}
+
+    def _load_components(self):
+        from raidne.game.things.components import IComponent, _component_accessors
+        import zope.interface as zi
+
+        self._components = {}
+        self._component_accessors = {}
+        for component in self._component_sources:
+            if isinstance(component, str):
+                module_name, _, class_name = component.partition(':')
+                component = getattr(importlib.import_module(module_name), class_name)
             for iface in zi.implementedBy(component):
                 if iface is IComponent:
                     continue
-                if iface in self.components:
+                if iface in self._components:
                     raise TypeError(
                         "Got two components for the same interface "
                         "({!r}): {!r} and {!r}"
-                        .format(iface, self.components[iface], component))
-                self.components[iface] = component
+                        .format(iface, self._components[iface], component))
+                self._components[iface] = component
+                self._component_accessors[iface] = _component_accessors(iface)
+
+    @property
+    def components(self):
+        """Interface => component class."""
+        if self._components is None:
+            self._load_components()
+        return self._components
+
+    @property
+    def component_accessors(self):
+        if self._component_accessors is None:
+            self._load_components()
+        return self._component_accessors
 
     def __call__(self, *args, **kwargs):
         return Thing(self, *args, **kwargs)
 
+    def shared_component(self, iface):
+        """Returns the one instance of a stateless component, shared by every
+        thing of this type.
+        """
+        component = self._shared_components.get(iface)
+        if component is None:
+            component = self._shared_components[iface] = self.components[iface](iface, None)
+        return component
+
 
     # TODO doc me bro
 
 ### ARCHITECTURE
-# TODO Most of these are immutable and can just be singletons; would save a lot
-# of rams.  Make it so.
 class Architecture(ThingType):
     """Some part of the dungeon layout: a floor, a trap, etc.  Every point on a
     dungeon floor has some kind of architecture.
+
+    Architecture is stateless, so each type has exactly one Thing, shared by
+    every tile that uses it.  Types are also registered under a small integer
+    code, so a floor's layout can be stored as a flat array of codes; see
+    `raidne.game.map.ArchitectureLayer`.
     """
+    category = ARCHITECTURE
+
+    # Indexed by type code, rather than by type id like ThingType.registry
+    by_code = []
+    # Parallel to by_code: whether each type code is solid
+    solid_codes = bytearray()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.type_code = len(Architecture.by_code)
+        assert self.type_code < 256
+        Architecture.by_code.append(self)
+        Architecture.solid_codes.append(bool(self.solid))
+
+        self.singleton = Thing(type=self)
+
+    def __call__(self):
+        # Nothing to tell one wall from another, so there's only the one
+        return self.singleton
 
 floor = Architecture()
 wall = Architecture(solid=True)
@@ -171,6 +332,8 @@ class Creature(ThingType):
     # XXX these should be controlled by something.
     #     probably depends how stats work, how species plays a part, how they
     #     affect health, etc.
+    category = CREATURE
+
     stats = None
     attack_power = 1
     name = "it"
@@ -188,44 +351,25 @@ player = Creature(max_health=10, name="you")
 
 
 ### ITEMS
-class Item(ThingType): pass
-
-
-
-
-import zope.interface as zi
-
-
-class IComponent(zi.Interface):
-    pass
-
-
-@zi.implementer(IComponent)
-class Component:
-    def __init__(self, iface, entity):
-        self.iface = iface
-        self.entity = entity
-
-    def __getattr__(self, key):
-        # TODO keyerror?  or let it raise?
-        attr = self.iface[key]
-        if isinstance(attr, zi.interface.Method):
-            raise AttributeError("missing method??")
-        elif isinstance(attr, zi.Attribute):
-            return self.entity._component_data[attr]
-        else:
-            # TODO ???  can this happen.  also are there other Attributes
-            raise AttributeError("wat")
+class Item(ThingType):
+    category = ITEM
 
+# ThingType classes that map exactly onto a category bit, for Thing.isa
+_category_classes = {
+    Architecture: ARCHITECTURE,
+    Creature: CREATURE,
+    Item: ITEM,
+}
 
-class IUsable(IComponent):
-    def use():
-        pass
+potion = Item('raidne.game.things.components:UsablePotion', name="potion")
 
 
-@zi.implementer(IUsable)
-class UsablePotion(Component):
-    def use(self):
-        return effect.Heal()
+# The component machinery lives in its own module, which is only imported
+# when something asks for it
+_component_names = ('IComponent', 'Component', 'IUsable', 'UsablePotion')
 
-potion = Item(UsablePotion, name="potion")
+def __getattr__(name):
+    if name in _component_names:
+        from raidne.game.things import components
+        return getattr(components, name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
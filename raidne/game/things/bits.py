@@ -5,7 +5,7 @@ class Meter(object):
     """HP or magic; some integral thing that has a maximum and can be lowered
     and filled.
     """
-    __slots__ = ('current', 'maximum')
+    __slots__ = ('current', 'maximum', 'watcher')
 
     def __init__(self, maximum):
         if maximum < 1:
@@ -14,6 +14,9 @@ class Meter(object):
         self.maximum = maximum
         self.current = maximum
 
+        # Called with no arguments whenever the value changes
+        self.watcher = None
+
     def modify(self, delta):
         """Modify the current value, capping between the maximum and zero."""
         self.current += delta
@@ -21,3 +24,6 @@ class Meter(object):
             self.current = 0
         elif self.current > self.maximum:
             self.current = self.maximum
+
+        if self.watcher is not None:
+            self.watcher()
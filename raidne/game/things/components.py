@@ -0,0 +1,73 @@
+"""Components: pieces of behavior that ThingTypes are assembled from, built on
+zope.interface.
+
+zope.interface is slow to import, so this module is only loaded once
+something actually needs a component -- usually by adapting a thing to one of
+the interfaces here.  `raidne.game.things` re-exports everything in it.
+"""
+import zope.interface as zi
+
+from raidne.game import effect
+
+
+class IComponent(zi.Interface):
+    pass
+
+
+def _missing_method(entity):
+    raise AttributeError("missing method??")
+
+def _component_accessors(iface):
+    """Works out, once, how a component for `iface` should find each of the
+    interface's attributes.
+    """
+    accessors = {}
+    for name, attr in iface.namesAndDescriptions(all=True):
+        if isinstance(attr, zi.interface.Method):
+            accessors[name] = _missing_method
+        elif isinstance(attr, zi.Attribute):
+            accessors[name] = lambda entity, attr=attr: entity.component_data[attr]
+        # TODO ???  are there other Attributes
+    return accessors
+
+
+@zi.implementer(IComponent)
+class Component:
+    # Set this if the component never looks at its entity; then there's only
+    # one of it per type, and its entity is None
+    stateless = False
+
+    def __init__(self, iface, entity):
+        self.iface = iface
+        self.entity = entity
+
+        if entity is not None:
+            self._accessors = entity._type.component_accessors[iface]
+        else:
+            self._accessors = _component_accessors(iface)
+
+    def __getattr__(self, key):
+        # Only called for things the class doesn't have, i.e. interface
+        # attributes.  Careful not to recurse before _accessors exists
+        if key == '_accessors':
+            raise AttributeError(key)
+        # TODO keyerror?  or let it raise?
+        try:
+            accessor = self._accessors[key]
+        except KeyError:
+            # Same as z.i raises for a name the interface doesn't have
+            raise KeyError(key)
+        return accessor(self.entity)
+
+
+class IUsable(IComponent):
+    def use():
+        pass
+
+
+@zi.implementer(IUsable)
+class UsablePotion(Component):
+    stateless = True
+
+    def use(self):
+        return effect.Heal()
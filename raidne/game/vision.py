@@ -0,0 +1,126 @@
+"""Who can see what.  Field of view is computed with recursive shadowcasting,
+treating solid architecture as opaque.
+"""
+
+# Multipliers for transforming coordinates into each of the eight octants
+_OCTANTS = (
+    (1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+    (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1),
+)
+
+class FieldOfView(object):
+    """What a particular viewer can see from where they're standing, and
+    everything they've ever seen on this map.
+
+    Results are cached: `refresh` only recomputes anything if the viewer has
+    moved, or if architecture within sight range has changed.  Positions in
+    `visible` and `remembered` are stored as bare (row, col) tuples, but
+    Positions work for lookups.
+
+    Sight is (close enough to) symmetric, so this doubles as a way to check
+    whether something can see the viewer.
+    """
+    radius = 12
+
+    def __init__(self, map, viewer, radius=None):
+        self.map = map
+        self.viewer = viewer
+        if radius is not None:
+            self.radius = radius
+
+        self.visible = frozenset()
+        self.remembered = set()
+        self._origin = None
+        self._changes = map.watch()
+
+    def close(self):
+        self.map.unwatch(self._changes)
+
+    def __contains__(self, position):
+        return position in self.visible
+
+    def can_see(self, position):
+        return position in self.visible
+
+    def refresh(self):
+        """Brings the field of view up to date.  Returns true if anything had
+        to be recomputed.
+        """
+        origin = self.map.position_of(self.viewer)
+        stale = origin != self._origin
+        if not stale and self._changes.architecture:
+            radius = self.radius
+            stale = any(
+                abs(position.row - origin.row) <= radius and
+                abs(position.col - origin.col) <= radius
+                for position in self._changes.architecture)
+        self._changes.clear()
+
+        if not stale:
+            return False
+
+        self._origin = origin
+        self.visible = frozenset(self._compute(origin))
+        new = self.visible - self.remembered
+        if new:
+            self.remembered.update(new)
+            self.map._touch_memory(new)
+        return True
+
+    def _compute(self, origin):
+        visible = {tuple(origin)}
+        for octant in _OCTANTS:
+            self._cast(visible, origin.row, origin.col, 1, 1.0, 0.0, *octant)
+        return visible
+
+    def _cast(self, visible, origin_row, origin_col, distance, start, end,
+              xx, xy, yx, yy):
+        """Scans one octant outwards from `distance`, between the slopes
+        `start` and `end`, recursing around anything opaque.
+        """
+        if start < end:
+            return
+
+        radius = self.radius
+        radius_squared = radius * radius
+        size = self.map.size
+        solid_at = self.map._architecture.solid_at
+
+        new_start = start
+        for j in range(distance, radius + 1):
+            dx = -j - 1
+            dy = -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                elif end > left_slope:
+                    break
+
+                col = origin_col + dx * xx + dy * xy
+                row = origin_row + dx * yx + dy * yy
+                if 0 <= row < size.rows and 0 <= col < size.cols:
+                    opaque = solid_at(row, col)
+                    if dx * dx + dy * dy < radius_squared:
+                        visible.add((row, col))
+                else:
+                    # The edge of the world is pretty opaque
+                    opaque = True
+
+                if blocked:
+                    if opaque:
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif opaque and j < radius:
+                    blocked = True
+                    self._cast(visible, origin_row, origin_col, j + 1,
+                        start, left_slope, xx, xy, yx, yy)
+                    new_start = right_slope
+
+            if blocked:
+                break
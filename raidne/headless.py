@@ -0,0 +1,261 @@
+"""Runs the game without any UI, with the player controlled by a script or a
+random policy.  Mostly useful for measuring how fast the engine is:
+
+    python -m raidne.headless --turns 10000 --rows 40 --cols 120 --density 0.02
+
+Reports turns per second, time spent in each phase of a turn, and peak memory.
+
+Runs can be recorded with --record and played back with --replay, which
+reproduces the game exactly: the log remembers the fractor the floors were
+made with and the monster density, so those options are ignored.  Games
+recorded in the console UI play back the same way.
+"""
+import argparse
+from collections import defaultdict, namedtuple
+import random
+import resource
+import time
+import tracemalloc
+
+from raidne import exceptions
+from raidne.game import action
+from raidne.game.dungeon import Dungeon
+from raidne.game.floorcache import FloorCache
+from raidne.game.fractor import BSPFractor
+from raidne.game.replay import ReplayLog, set_up, start
+from raidne.game.things.bits import Meter
+from raidne.util import Offset
+
+### Player policies
+# A policy is a function that takes the dungeon and returns the player's next
+# action.
+
+DIRECTIONS = {
+    'k': Offset(drow=-1, dcol=0),
+    'j': Offset(drow=+1, dcol=0),
+    'h': Offset(drow=0, dcol=-1),
+    'l': Offset(drow=0, dcol=+1),
+}
+
+def _act_in_direction(dungeon, direction):
+    """Same thing the console UI does when you press an arrow key: attack
+    whatever's there, or walk there.
+    """
+    player = dungeon.player
+    floor = dungeon.current_floor
+    target = direction.relative_to(floor.position_of(player))
+    creature = floor.tile(target).creature
+    if creature:
+        return action.MeleeAttack(player, creature)
+    return action.Walk(player, direction)
+
+def random_policy(rng):
+    """Stumbles around at random, attacking anything in the way."""
+    directions = list(DIRECTIONS.values())
+    def policy(dungeon):
+        return _act_in_direction(dungeon, rng.choice(directions))
+    return policy
+
+def scripted_policy(script):
+    """Follows a string of vi keys (hjkl to move, `.` to wait), looping back
+    to the start when it runs out.
+    """
+    assert script
+    steps = [DIRECTIONS.get(key) for key in script]
+    def policy(dungeon):
+        direction = steps[policy.turn % len(steps)]
+        policy.turn += 1
+        if direction is None:
+            return action.Wait(dungeon.player)
+        return _act_in_direction(dungeon, direction)
+    policy.turn = 0
+    return policy
+
+def replay_policy(log, dungeon):
+    """Plays back the actions in a `ReplayLog`, then gives up."""
+    actions = log.actions(dungeon)
+    def policy(dungeon):
+        return next(actions, None)
+    return policy
+
+
+### Instrumentation
+
+class ProfiledDungeon(Dungeon):
+    """A Dungeon that keeps track of how long each phase of a turn takes:
+    monster AI, carrying out actions and their effects, and the map mutations
+    those cause (which are counted as part of the effects, too).
+    """
+    _mutators = ('put', 'remove', 'move', 'set_architecture')
+
+    def __init__(self, *args, **kwargs):
+        self.phase_times = defaultdict(float)
+        super().__init__(*args, **kwargs)
+
+    def _floor_loaded(self, floor):
+        for name in self._mutators:
+            setattr(floor, name, self._timed('map mutation', getattr(floor, name)))
+        super()._floor_loaded(floor)
+
+    def _timed(self, phase, func):
+        phase_times = self.phase_times
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phase_times[phase] += time.perf_counter() - start
+        return timed
+
+    def _think(self, actor, floor):
+        start = time.perf_counter()
+        try:
+            return super()._think(actor, floor)
+        finally:
+            self.phase_times['think'] += time.perf_counter() - start
+
+    def _perform(self, action):
+        start = time.perf_counter()
+        try:
+            return super()._perform(action)
+        finally:
+            self.phase_times['effects'] += time.perf_counter() - start
+
+
+### Running
+
+SimulationResult = namedtuple('SimulationResult',
+    ('turns', 'elapsed', 'phase_times', 'peak_memory', 'died'))
+
+def simulate(dungeon, policy, turns=None, immortal=True, trace_memory=False):
+    """Plays `turns` turns of the game, or until the policy returns `None`.
+    The player normally can't die, so long runs aren't cut short; otherwise
+    the run ends when they do.
+
+    Peak memory is only measured (with `tracemalloc`) if asked for, since it
+    slows everything down considerably.
+    """
+    if immortal:
+        dungeon.player.health = Meter(2**30)
+
+    if trace_memory:
+        tracemalloc.start()
+
+    died = False
+    start = time.perf_counter()
+    played = 0
+    try:
+        while turns is None or played < turns:
+            command = policy(dungeon)
+            if command is None:
+                break
+            dungeon.player_command(command)
+            dungeon.do_monster_turns()
+            played += 1
+    except exceptions.GameOver:
+        died = True
+    elapsed = time.perf_counter() - start
+
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return SimulationResult(
+        turns=played,
+        elapsed=elapsed,
+        phase_times=dict(getattr(dungeon, 'phase_times', {})),
+        peak_memory=peak_memory,
+        died=died,
+    )
+
+def run(rows, cols, density, turns=None, seed=None, script=None, replay=None,
+        trace_memory=False, floor_cache=None, creature_stores=False):
+    """Builds a fresh dungeon with the given floor size and monster density,
+    and simulates it.  Returns the dungeon and a `SimulationResult`.
+
+    When replaying, the floor size and density are whatever the log was
+    recorded with, and the player is only immortal if they were then.
+    """
+    if replay is not None:
+        dungeon = start(
+            replay, ProfiledDungeon,
+            floor_cache=floor_cache, creature_stores=creature_stores)
+        policy = replay_policy(replay, dungeon)
+    else:
+        if seed is None:
+            seed = random.randrange(2**64)
+        rng = random.Random(seed)
+        # Monsters come from the density instead, so the floors shouldn't
+        # bring their own
+        dungeon = ProfiledDungeon(
+            seed=seed, fractor=BSPFractor(height=rows, width=cols, spawn_density=0),
+            floor_cache=floor_cache, creature_stores=creature_stores, prefetch=False)
+        # The player can't die, so long runs aren't cut short
+        dungeon.replay_log.metadata.update(density=density, immortal=True)
+        set_up(dungeon, rng)
+        if script:
+            policy = scripted_policy(script)
+        else:
+            policy = random_policy(rng)
+
+    # set_up() has already taken care of the player's health
+    result = simulate(dungeon, policy, turns, immortal=False, trace_memory=trace_memory)
+    return dungeon, result
+
+def format_result(result):
+    lines = []
+    lines.append("{0} turns in {1:.3f}s: {2:.1f} turns/sec{3}".format(
+        result.turns, result.elapsed, result.turns / result.elapsed,
+        " (player died)" if result.died else ""))
+    for phase, seconds in sorted(result.phase_times.items()):
+        lines.append("  {0:<14} {1:8.3f}s  {2:5.1f}%".format(
+            phase, seconds, 100 * seconds / result.elapsed))
+    if result.peak_memory is not None:
+        lines.append("  peak traced memory: {0:.1f} KiB".format(
+            result.peak_memory / 1024))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the game without a UI.")
+    parser.add_argument('--turns', type=int, default=None,
+        help="default is 1000, or the whole log when replaying")
+    parser.add_argument('--rows', type=int, default=BSPFractor.height)
+    parser.add_argument('--cols', type=int, default=BSPFractor.width)
+    parser.add_argument('--density', type=float, default=0.01,
+        help="fraction of open tiles to fill with monsters")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--script', default=None,
+        help="vi keys for the player to follow (hjkl.); default is random")
+    parser.add_argument('--record', metavar='FILE',
+        help="save a replay log of the run")
+    parser.add_argument('--replay', metavar='FILE',
+        help="play back a replay log instead of a policy")
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--floor-cache', metavar='DIR',
+        help="reuse floors generated by earlier runs, stored in DIR")
+    parser.add_argument('--creature-stores', action='store_true',
+        help="keep creature stats in columnar stores")
+    args = parser.parse_args(argv)
+
+    replay = None
+    turns = args.turns
+    if args.replay:
+        replay = ReplayLog.load(args.replay)
+    elif turns is None:
+        turns = 1000
+
+    dungeon, result = run(
+        rows=args.rows, cols=args.cols, density=args.density,
+        turns=turns, seed=args.seed, script=args.script, replay=replay,
+        trace_memory=args.trace_memory,
+        floor_cache=FloorCache(args.floor_cache) if args.floor_cache else None,
+        creature_stores=args.creature_stores)
+    if args.record:
+        dungeon.replay_log.save(args.record)
+    print(format_result(result))
+    print("  max rss: {0} KiB".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+if __name__ == '__main__':
+    main()
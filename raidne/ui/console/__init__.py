@@ -1,6 +1,9 @@
 # encoding: utf8
 """NetHack-style console interface."""
 
+import argparse
+import os.path
+
 import urwid
 import urwid.util
 from urwid.main_loop import ExitMainLoop
@@ -8,8 +11,10 @@ from urwid.util import apply_target_encoding, rle_append_modify, rle_len
 
 from raidne.game import action
 from raidne.game.dungeon import Dungeon
-from raidne.ui.console.rendering import PALETTE_ENTRIES, rendering_for
-from raidne.util import Offset, Position
+from raidne.ui.console.rendering import (
+    PALETTE_ENTRIES, compile_glyphs, glyph_for_type, remembered_glyph_for_type,
+    unseen_glyph)
+from raidne.util import Offset
 
 # TODO probably needs to be scrollable -- in which case the SolidFill overlay below can go away
 class PlayingFieldWidget(urwid.BoxWidget):
@@ -17,6 +22,27 @@ class PlayingFieldWidget(urwid.BoxWidget):
         # XXX should this just accept a map, even?
         self.dungeon = dungeon
 
+        # Rendered rows are cached, and only the ones the map says have
+        # changed get redrawn.  The cache belongs to a particular map and
+        # screen size, and is thrown away if either changes.
+        self._map = None
+        self._changes = None
+        self._size = None
+        self._rows = {}
+        self._blank_row = None
+
+        # Only what the player can see is drawn, plus whatever they remember
+        # seeing.  Rows whose visibility changed are redrawn too.
+        self._sight = None
+        self._visible = frozenset()
+        self._stale_rows = set()
+
+        # Map coordinates of the top left corner of the screen.  Floors
+        # bigger than the screen scroll to follow the player.
+        self._origin = None
+
+        compile_glyphs(urwid.util._target_encoding)
+
     #def pack(self, size, focus=False):
     #    # Returns the size of the fixed playing field.
     #    #return self.dungeon.current_floor.size
@@ -31,48 +57,149 @@ class PlayingFieldWidget(urwid.BoxWidget):
         chars.append(encoded_char)
         rle_append_modify(attrs, (None, len(encoded_char)))
 
+    def _follow_map(self):
+        """Starts watching the current floor for changes, if it isn't already
+        the one being watched.  Returns true if the cache had to be dropped.
+        """
+        map = self.dungeon.current_floor
+        if map is self._map:
+            return False
+
+        if self._map is not None:
+            self._map.unwatch(self._changes)
+        self._map = map
+        self._changes = map.watch()
+        self._rows.clear()
+        self._visible = frozenset()
+        self._origin = None
+        return True
 
-    def render(self, size, focus=False):
-        # Build a view of the architecture
-        viewport = []
+    def _follow_sight(self):
+        """Updates the player's field of view, marking any rows where
+        visibility changed as stale.  Returns true if there were any.
+        """
+        self._sight = self._map.field_of_view(self.dungeon.player)
+        visible = self._sight.visible
+        if visible is self._visible:
+            return False
+
+        self._stale_rows.update(row for row, col in visible ^ self._visible)
+        self._visible = visible
+        return True
+
+    def update(self):
+        """Asks urwid to redraw the map, but only if something on it changed.
+        """
+        new_map = self._follow_map()
+        new_sight = self._follow_sight()
+        if new_map or new_sight or self._changes:
+            self._invalidate()
+
+    def _render_row(self, row, maxcol, left):
+        map = self._map
+        chars = []
         attrs = []
-        map = self.dungeon.current_floor
 
-        maxcol, maxrow = size
-        top, left = 0, 0
+        # Only the columns that are actually on screen get drawn
+        start = max(left, 0)
+        stop = max(min(left + maxcol, map.size.cols), start)
+
+        # Blank space for the left padding
+        self._render_padding(start - left, chars=chars, attrs=attrs)
+
+        visible = self._visible
+        remembered = self._sight.remembered
+        architecture_types = map.architecture_types(row, start, stop)
+        for col, thing_type in enumerate(map.topmost_types(row, start, stop), start):
+            cell = row, col
+            if cell in visible:
+                glyph = glyph_for_type(thing_type)
+            elif cell in remembered:
+                glyph = remembered_glyph_for_type(architecture_types[col - start])
+            else:
+                glyph = unseen_glyph()
+            chars.append(glyph.encoded)
+            rle_append_modify(attrs, (glyph.palette, len(glyph.encoded)))
+
+        # Blank space for the right padding
+        self._render_padding(maxcol - (stop - left), chars=chars, attrs=attrs)
+
+        return b''.join(chars), attrs
+
+    def _scroll_axis(self, origin, position, span, extent):
+        """Works out where the screen should start along one axis, so that
+        `position` is comfortably inside it.  Only moves when the player gets
+        near the edge, and then jumps to recenter them, so the cached rows
+        don't all go stale every turn.
+        """
+        if extent <= span:
+            return 0
 
-        # TODO actually compute the offset more cleverly here  :)
-        # TODO optimize me more??  somehow?
+        margin = span // 4
+        if origin is None or not (origin + margin <= position < origin + span - margin):
+            origin = position - span // 2
+        return max(0, min(origin, extent - span))
 
-        for screen_row in range(maxrow):
-            viewport_chars = []
-            attr_row = []
+    def _scroll(self, size):
+        """Updates the origin to keep the player in view, throwing away the
+        cached rows if it moved.
+        """
+        maxcol, maxrow = size
+        map = self._map
+        top, left = self._origin or (None, None)
+        try:
+            row, col = map.position_of(self.dungeon.player)
+        except ValueError:
+            # No player around to follow
+            row, col = top or 0, left or 0
+
+        origin = (
+            self._scroll_axis(top, row, maxrow, map.size.rows),
+            self._scroll_axis(left, col, maxcol, map.size.cols))
+        if origin != self._origin:
+            self._origin = origin
+            self._rows.clear()
+        return origin
 
-            if screen_row < top or screen_row >= map.size.rows + top:
-                # Outside the bounds of the map; just show blank space
-                self._render_padding(maxcol, chars=viewport_chars, attrs=attr_row)
+    def render(self, size, focus=False):
+        self._follow_map()
+        self._follow_sight()
+        map = self._map
 
-                viewport.append(b''.join(viewport_chars))
-                attrs.append(attr_row)
-                continue
+        maxcol, maxrow = size
 
-            # Blank space for the left padding
-            self._render_padding(left, chars=viewport_chars, attrs=attr_row)
+        if size != self._size:
+            self._size = size
+            self._rows.clear()
 
-            for col in range(map.size.cols):
-                pos = Position(screen_row - top, col)
-                char, palette = rendering_for(map.tile(pos).topmost)
+            chars = []
+            attrs = []
+            self._render_padding(maxcol, chars=chars, attrs=attrs)
+            self._blank_row = b''.join(chars), attrs
 
-                # XXX this is getting way inefficient man; surely a better approach
-                encoded_char = char.encode(urwid.util._target_encoding)
-                viewport_chars.append(encoded_char)
-                rle_append_modify(attr_row, (palette, len(encoded_char)))
+        top, left = self._scroll(size)
 
-            # Blank space for the right padding
-            self._render_padding((maxcol - map.size.cols - left),
-                chars=viewport_chars, attrs=attr_row)
+        # Forget about any rows that have changed since the last frame
+        for position in self._changes.positions:
+            self._rows.pop(position.row, None)
+        self._changes.clear()
+        for row in self._stale_rows:
+            self._rows.pop(row, None)
+        self._stale_rows.clear()
 
-            viewport.append(b''.join(viewport_chars))
+        viewport = []
+        attrs = []
+        for screen_row in range(maxrow):
+            row = screen_row + top
+            if row < 0 or row >= map.size.rows:
+                # Outside the bounds of the map; just show blank space
+                chars, attr_row = self._blank_row
+            else:
+                if row not in self._rows:
+                    self._rows[row] = self._render_row(row, maxcol, left)
+                chars, attr_row = self._rows[row]
+
+            viewport.append(chars)
             attrs.append(attr_row)
 
         map_canv = urwid.TextCanvas(viewport, attr=attrs)
@@ -196,8 +323,9 @@ class MainWidget(urwid.PopUpLauncher):
     _selectable = True
     _sizing = 'box'
 
-    def __init__(self, dungeon):
+    def __init__(self, dungeon, autosave=None):
         self.dungeon = dungeon
+        self.autosave = autosave
 
         self.playing_field = PlayingFieldWidget(dungeon)
         play_area = urwid.Overlay(
@@ -239,7 +367,7 @@ class MainWidget(urwid.PopUpLauncher):
         elif key == '>':
             self.dungeon.player_command(action.Descend(self.dungeon.player, self.dungeon.current_floor.find(self.dungeon.player).architecture))
         elif key == '.':
-            pass
+            self.dungeon.player_command(action.Wait(self.dungeon.player))
         elif key == ',':
             # XXX broken
             self.dungeon.player_command(action.PickUp(self.dungeon.player, self.dungeon.current_floor.find(self.dungeon.player).items[0]))
@@ -256,6 +384,8 @@ class MainWidget(urwid.PopUpLauncher):
         # events, other delays, whatever.
         # TODO if that's the case, how do we update between monster turns?
         self.dungeon.do_monster_turns()
+        if self.autosave:
+            self.autosave.save()
 
         self.update_widgets()
 
@@ -280,11 +410,9 @@ class MainWidget(urwid.PopUpLauncher):
 
 
     def update_widgets(self):
-        # Update the display
-        # TODO this is max inefficient
-        # TODO: _invalidate() should probably be decided by the dungeon floor.
-        # could use some more finely-tuned form of repainting
-        self.playing_field._invalidate()
+        # Update the display.  The playing field only repaints if the floor
+        # reports any changes
+        self.playing_field.update()
 
         self.message_pane.update()
 
@@ -319,14 +447,27 @@ class MainWidget(urwid.PopUpLauncher):
 
 class RaidneInterface(object):
 
-    def __init__(self):
+    def __init__(self, seed=None, record=None, autosave=None):
+        self.seed = seed
+        self.record = record
+        self.autosave_path = autosave
         self.init_display()
 
     def init_display(self):
-        self.dungeon = Dungeon()
-        self.dungeon.message('Welcome to raidne!')
+        autosave = None
+        if self.autosave_path:
+            from raidne.game.journal import Autosave, load_autosave
+        if self.autosave_path and os.path.exists(self.autosave_path):
+            self.dungeon = load_autosave(Dungeon, self.autosave_path, prefetch=False)
+            self.dungeon.message('Welcome back!')
+        else:
+            # The next floor can wait until there's something on screen
+            self.dungeon = Dungeon(seed=self.seed, prefetch=False)
+            self.dungeon.message('Welcome to raidne!')
+        if self.autosave_path:
+            autosave = Autosave(self.dungeon, self.autosave_path)
         # FIXME this is a circular reference.  can urwid objects find their own containers?
-        self.main_widget = MainWidget(self.dungeon)
+        self.main_widget = MainWidget(self.dungeon, autosave=autosave)
 
     def run(self):
         self.loop = urwid.MainLoop(self.main_widget, pop_ups=True)
@@ -334,13 +475,35 @@ class RaidneInterface(object):
         # XXX what happens if the terminal doesn't actually support 256 colors?
         self.loop.screen.set_terminal_properties(colors=256)
         self.loop.screen.register_palette(PALETTE_ENTRIES)
+        compile_glyphs(urwid.util._target_encoding)
+
+        # Start on the next floor once the first frame is up; urwid draws as
+        # soon as it goes idle, well before this fires
+        self.loop.set_alarm_in(0.1, lambda loop, data: self.dungeon.start_prefetching())
 
         # Game loop
-        self.loop.run()
+        try:
+            self.loop.run()
+        finally:
+            # Save the replay even if the game blew up; that's when it's most
+            # interesting
+            if self.record:
+                self.dungeon.replay_log.save(self.record)
+            self.dungeon.close()
 
         # End
         print("Bye!")
 
 
-def main():
-    RaidneInterface().run()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play raidne.")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--record', metavar='FILE',
+        help="save a replay log of the game; play it back with "
+             "`python -m raidne.headless --replay FILE`")
+    parser.add_argument('--autosave', metavar='FILE',
+        help="save the game to FILE after every turn, and resume from it if "
+             "it exists")
+    args = parser.parse_args(argv)
+
+    RaidneInterface(seed=args.seed, record=args.record, autosave=args.autosave).run()
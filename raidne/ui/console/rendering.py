@@ -1,13 +1,15 @@
 # encoding: utf8
 """Console rendering for every Thing in the game.
 
-Contains a single function, `rendering_for`, which accepts a Thing argument and
-returns (character, palette_entry).
+Contains a table of `Glyph`s indexed by ThingType id, which is compiled for
+the terminal's encoding with `compile_glyphs` -- or, if nothing's done that
+yet, on first use with whatever encoding urwid has picked.  `glyph_for` and
+`rendering_for` look things up in it.
 
 Also contains a list `PALETTE_ENTRIES`, containing the palette used by
 everything in the game.
 """
-from functools import partial
+from collections import namedtuple
 
 from raidne.game import things
 
@@ -24,6 +26,7 @@ PALETTE_ENTRIES = [
 
     # Architecture
     ('floor', 'black', 'default', None, '#666', 'default'),
+    ('remembered', 'dark gray', 'default', None, '#333', 'default'),
 
     # Creatures
     ('player', 'yellow', 'default', None, '#ff6', 'default'),
@@ -36,25 +39,97 @@ PALETTE_ENTRIES = [
 
 # TODO most likely things should express what they look "like" and then this
 # should key off of that
+GLYPH_SOURCES = [
+    # (thing type, character, palette entry)
+
+    # Architecture
+    (things.floor, u'·', 'floor'),
+    (things.wall, u'▒', 'default'),
+    (things.staircase_up, u'▛', 'default'),
+    (things.staircase_down, u'▙', 'default'),
+    (things.trap, u'X', 'default'),
+
+    # Creatures
+    (things.player, u'☻', 'player'),
+    (things.newt, u':', 'newt'),
+
+    # Items
+    (things.potion, u'ᵭ', 'potion'),
+]
+
+UNKNOWN_GLYPH_SOURCE = (u'‽', 'default')
+UNSEEN_GLYPH_SOURCE = (u' ', None)
+
+
+class Glyph(namedtuple('Glyph', ('char', 'palette', 'encoded'))):
+    """How a ThingType looks on screen: a character, its palette entry, and
+    the character already encoded for the terminal.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, char, palette, encoding):
+        # A terminal that can't show the character gets a ? instead
+        return cls(char, palette, char.encode(encoding, 'replace'))
+
+
+# Indexed by ThingType.type_id
+_glyphs = []
+_remembered_glyphs = []
+_unknown_glyph = None
+_unseen_glyph = None
+_glyph_encoding = None
+
+def compile_glyphs(encoding):
+    """Builds the glyph table for the given target encoding.  Call this once
+    the screen is set up; calling it again with the same encoding is free.
+    """
+    global _unknown_glyph, _unseen_glyph, _glyph_encoding
+    if encoding == _glyph_encoding:
+        return
+
+    _unknown_glyph = Glyph.compile(*UNKNOWN_GLYPH_SOURCE, encoding=encoding)
+    _glyphs[:] = [_unknown_glyph] * len(things.ThingType.registry)
+    _remembered_glyphs[:] = _glyphs
+    for thing_type, char, palette in GLYPH_SOURCES:
+        _glyphs[thing_type.type_id] = Glyph.compile(char, palette, encoding)
+        # Architecture that's out of sight is drawn dimmed
+        _remembered_glyphs[thing_type.type_id] = Glyph.compile(char, 'remembered', encoding)
+    _unseen_glyph = Glyph.compile(*UNSEEN_GLYPH_SOURCE, encoding=encoding)
+    _glyph_encoding = encoding
+
+def _compile_default_glyphs():
+    import urwid.util
+    compile_glyphs(urwid.util._target_encoding)
+
+def glyph_for_type(thing_type):
+    type_id = thing_type.type_id
+    if type_id < len(_glyphs):
+        return _glyphs[type_id]
+    if _glyph_encoding is None:
+        _compile_default_glyphs()
+        return glyph_for_type(thing_type)
+    # Types made after the table was compiled have no glyph
+    return _unknown_glyph
+
+def remembered_glyph_for_type(thing_type):
+    type_id = thing_type.type_id
+    if type_id < len(_remembered_glyphs):
+        return _remembered_glyphs[type_id]
+    if _glyph_encoding is None:
+        _compile_default_glyphs()
+        return remembered_glyph_for_type(thing_type)
+    return _unknown_glyph
+
+def unseen_glyph():
+    if _glyph_encoding is None:
+        _compile_default_glyphs()
+    return _unseen_glyph
+
+def glyph_for(thing):
+    return glyph_for_type(thing.type)
+
 def rendering_for(thing):
-    if thing.isa(things.Architecture):
-        if thing.isa(things.floor):
-            return u'·', 'floor'
-        if thing.isa(things.wall):
-            return u'▒', 'default'
-        if thing.isa(things.staircase_down):
-            return u'▙', 'default'
-        if thing.isa(things.trap):
-            return u'X', 'default'
-
-    elif thing.isa(things.Creature):
-        if thing.isa(things.player):
-            return u'☻', 'player'
-        if thing.isa(things.newt):
-            return u':', 'newt'
-
-    elif thing.isa(things.Item):
-        if thing.isa(things.potion):
-            return u'ᵭ', 'potion'
-
-    return u'‽', 'default'
+    """Returns (character, palette_entry) for a Thing."""
+    glyph = glyph_for(thing)
+    return glyph.char, glyph.palette
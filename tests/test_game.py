@@ -0,0 +1,257 @@
+"""Round trips through the on-disk formats, and the floor-building algorithms
+checked against the slow obvious way of doing the same thing.
+"""
+import os
+import random
+
+from raidne import headless
+from raidne.game import action, connectivity, population, storage, things
+from raidne.game.dungeon import Dungeon
+from raidne.game.floorcache import FloorCache
+from raidne.game.fractor import Box, BoxIndex, BSPFractor
+from raidne.game.journal import Autosave, journal_path, load_autosave
+from raidne.game.things.bits import Meter
+from raidne.util import Position
+
+
+### Playing
+
+def new_dungeon(seed=42):
+    dungeon = Dungeon(seed=seed, fractor=BSPFractor(height=30, width=80), prefetch=False)
+    population.populate_density(dungeon.current_floor, 0.03, random.Random(seed))
+    dungeon.player.health = Meter(2**30)
+    return dungeon
+
+def descend(dungeon):
+    floor = dungeon.current_floor
+    stairs = next(
+        position for position in floor.size.iter_positions()
+        if floor.tile(position).architecture.isa(things.staircase_down))
+    squatter = floor.tile(stairs).creature
+    if squatter is not None:
+        floor.remove(squatter)
+    floor.move(dungeon.player, stairs)
+    dungeon.player_command(action.Descend(dungeon.player, floor.tile(stairs).architecture))
+    dungeon.do_monster_turns()
+
+def play(dungeon, rng, turns, after_turn=None):
+    """Stumbles around at random for `turns` turns, taking the stairs down
+    every so often.
+    """
+    policy = headless.random_policy(rng)
+    for turn in range(turns):
+        if turn % 40 == 39:
+            descend(dungeon)
+        else:
+            dungeon.player_command(policy(dungeon))
+            dungeon.do_monster_turns()
+        # As the UI would, so there's something remembered to save
+        dungeon.current_floor.field_of_view(dungeon.player)
+        if after_turn is not None:
+            after_turn()
+
+def snapshot(dungeon):
+    """Everything about a game that ought to survive saving and loading, as
+    plain values.  Floors are normalized by loading and dumping them again,
+    since some are only stored compressed.
+    """
+    floors = {}
+    for depth in dungeon.floors.depths():
+        map, _ = storage.load_floor(dungeon.floors.floor_bytes(depth))
+        floors[depth] = storage.dump_floor(map)
+    return (
+        floors,
+        storage.dump_floor(dungeon.current_floor, player=dungeon.player),
+        dungeon.replay_log.to_bytes(),
+        dungeon.pending_messages(),
+        storage.dump_moving_things(dungeon.moving_things),
+    )
+
+def copy_rng(rng):
+    copy = random.Random()
+    copy.setstate(rng.getstate())
+    return copy
+
+def assert_plays_on_the_same(dungeon, loaded, rng):
+    assert snapshot(loaded) == snapshot(dungeon)
+    play(dungeon, copy_rng(rng), 60)
+    play(loaded, copy_rng(rng), 60)
+    assert snapshot(loaded) == snapshot(dungeon)
+
+
+### Saved games
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'save')
+    rng = random.Random(1)
+    dungeon = new_dungeon()
+    play(dungeon, rng, 130)
+    assert dungeon.current_floor.depth == 3
+    assert dungeon.current_floor.remembered()
+
+    dungeon.save(path)
+    loaded = Dungeon.load(path, prefetch=False)
+    assert loaded.current_floor.field_of_view(loaded.player).remembered >= (
+        dungeon.current_floor.remembered())
+    assert_plays_on_the_same(dungeon, loaded, rng)
+
+def test_autosave(tmp_path):
+    path = str(tmp_path / 'autosave')
+    rng = random.Random(2)
+    dungeon = new_dungeon()
+    autosave = Autosave(dungeon, path)
+    play(dungeon, rng, 130, after_turn=autosave.save)
+
+    loaded = load_autosave(Dungeon, path, prefetch=False)
+    assert_plays_on_the_same(dungeon, loaded, rng)
+
+def test_autosave_across_checkpoints(tmp_path):
+    path = str(tmp_path / 'autosave')
+    rng = random.Random(3)
+    dungeon = new_dungeon()
+    autosave = Autosave(dungeon, path)
+    autosave.compact_every = 25
+    play(dungeon, rng, 130, after_turn=autosave.save)
+
+    loaded = load_autosave(Dungeon, path, prefetch=False)
+    assert_plays_on_the_same(dungeon, loaded, rng)
+
+def test_torn_journal(tmp_path):
+    path = str(tmp_path / 'autosave')
+    rng = random.Random(4)
+    dungeon = new_dungeon()
+    autosave = Autosave(dungeon, path)
+    autosave.compact_every = autosave.compact_ratio = 10**6
+
+    ends = []
+    snapshots = []
+    def save():
+        autosave.save()
+        ends.append(os.path.getsize(journal_path(path)))
+        snapshots.append(snapshot(dungeon))
+    play(dungeon, rng, 90, after_turn=save)
+
+    with open(journal_path(path), 'rb') as f:
+        journal = f.read()
+    for k in (0, 38, 39, 40, 88):
+        # Cut off partway through the next entry, or scribble on it
+        end = ends[k]
+        for torn in (journal[:end + 3], journal[:(end + ends[k + 1]) // 2],
+                journal[:end] + b'\xff' * (ends[k + 1] - end)):
+            with open(journal_path(path), 'wb') as f:
+                f.write(torn)
+            loaded = load_autosave(Dungeon, path, prefetch=False)
+            assert snapshot(loaded) == snapshots[k]
+
+    # Saving again carries on from the last good entry
+    resumed = Autosave(loaded, path)
+    play(loaded, random.Random(5), 5, after_turn=resumed.save)
+    assert snapshot(load_autosave(Dungeon, path, prefetch=False)) == snapshot(loaded)
+
+
+### Floor cache
+
+def test_truncated_cache_entry(tmp_path):
+    cache = FloorCache(str(tmp_path))
+    fractor = BSPFractor()
+    expected = storage.dump_floor(cache.generate(fractor, 5))
+    path, = (entry.path for entry in os.scandir(str(tmp_path)))
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    cuts = [0, 1, 3000, len(data) - 1] + list(range(10, len(data), len(data) // 50))
+    for cut in cuts:
+        with open(path, 'wb') as f:
+            f.write(data[:cut])
+        assert storage.dump_floor(cache.generate(fractor, 5)) == expected
+        # And it's been replaced
+        assert os.path.getsize(path) == len(data)
+    assert cache.misses == 1 + len(cuts)
+
+
+### Connectivity
+
+def flood_fill(codes, rows, cols):
+    """Returns a component number for every tile, or -1 for solid ones."""
+    solid = things.Architecture.solid_codes
+    components = [-1] * (rows * cols)
+    count = 0
+    for first in range(rows * cols):
+        if solid[codes[first]] or components[first] >= 0:
+            continue
+        components[first] = count
+        stack = [first]
+        while stack:
+            index = stack.pop()
+            row, col = divmod(index, cols)
+            for neighbor, ok in (
+                    (index - cols, row > 0), (index + cols, row < rows - 1),
+                    (index - 1, col > 0), (index + 1, col < cols - 1)):
+                if ok and components[neighbor] < 0 and not solid[codes[neighbor]]:
+                    components[neighbor] = count
+                    stack.append(neighbor)
+        count += 1
+    return components, count
+
+def random_floors(seed, count=200):
+    rng = random.Random(seed)
+    floor, wall = things.floor.type_code, things.wall.type_code
+    for _ in range(count):
+        rows, cols = rng.randint(1, 30), rng.randint(1, 30)
+        openness = rng.random()
+        codes = bytearray(
+            floor if rng.random() < openness else wall for _ in range(rows * cols))
+        yield codes, rows, cols
+
+def test_regions_match_flood_fill():
+    for codes, rows, cols in random_floors(1):
+        regions = connectivity.Regions(codes, rows, cols)
+        components, count = flood_fill(codes, rows, cols)
+        assert len(regions) == count
+
+        # Labels are numbered in the order they're first found, just like
+        # the flood fill's components
+        for index, component in enumerate(components):
+            label = regions.region_at(Position(*divmod(index, cols)))
+            assert label == (None if component < 0 else component)
+        for label, representative in enumerate(regions.representatives):
+            first = components.index(label)
+            assert representative == Position(*divmod(first, cols))
+            assert regions.sizes[label] == components.count(label)
+
+def test_connect_joins_everything():
+    for codes, rows, cols in random_floors(2):
+        before = bytes(codes)
+        _, count = flood_fill(codes, rows, cols)
+        regions, dug = connectivity.connect(codes, rows, cols)
+        assert len(regions) == count
+        assert dug == max(count - 1, 0)
+        assert flood_fill(codes, rows, cols)[1] == min(count, 1)
+        # Only ever digs
+        solid = things.Architecture.solid_codes
+        for old, new in zip(before, codes):
+            assert old == new or (solid[old] and not solid[new])
+
+
+### Box index
+
+def test_box_index_matches_brute_force():
+    rng = random.Random(3)
+    def random_box():
+        return Box(rng.randint(-20, 200), rng.randint(-20, 200), rng.randint(0, 40), rng.randint(0, 40))
+
+    index = BoxIndex(bucket_size=8)
+    boxes = []
+    for _ in range(300):
+        box = random_box()
+        index.add(box)
+        boxes.append(box)
+    assert list(index) == boxes
+
+    for _ in range(500):
+        query = random_box()
+        expected = [box for box in boxes if query.overlaps(box)]
+        found = index.overlapping(query)
+        assert sorted(found) == sorted(expected)
+        assert len(found) == len(set(map(id, found)))
+        assert index.any_overlapping(query) == bool(expected)